@@ -0,0 +1,84 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from client import Client
+
+
+class AsyncClient:
+    """
+    Asyncio interface of a `Client`.
+
+    The scheme itself is run by the client, the blocking requests and computations are run in a thread pool. The
+    search results are split into batches that each get their decryption keys in their own consultant request, so the
+    requests are in flight at the same time and a batch is decrypted as soon as its keys arrive.
+    """
+
+    def __init__(self, client: Client, workers: int = config.CONNECTION_POOL_SIZE,
+                 batch_size: int = config.DECRYPTION_BATCH_SIZE):
+        """
+        :param client: The client that has joined the group
+        :param workers: The number of threads that run requests and computations
+        :param batch_size: The number of search results to decrypt per consultant request
+        """
+        self.client = client
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def upload_file(self, file_contents, keywords):
+        await self._run(self.client.upload_file, file_contents, keywords)
+
+    async def get_files_by_keywords(self, keywords):
+        """
+        Get the files that contain the keywords
+        :return: List of the decrypted files, or Access Denied
+        """
+        search = await self._run(self.client._search_files, keywords)
+        if search == config.ACCESS_DENIED:
+            return config.ACCESS_DENIED
+        search_results, CTi_serialized = search
+        return await self._decrypt_files(search_results, CTi_serialized)
+
+    async def get_files_by_keywords_page(self, keywords, limit, cursor=None):
+        """
+        Get one page of the files that contain the keywords
+        :return: Tuple (files, cursor) where cursor is None after the last page, or Access Denied
+        """
+        search = await self._run(self.client._search_files_page, keywords, limit, cursor)
+        if search == config.ACCESS_DENIED:
+            return config.ACCESS_DENIED
+        search_results, cursor, CTi_serialized = search
+        return await self._decrypt_files(search_results, CTi_serialized), cursor
+
+    async def iter_files_by_keywords(self, keywords, page_size=config.PAGE_SIZE):
+        """
+        Iterate over the files that contain the keywords, the next page is fetched while the current one is consumed
+        """
+        page = asyncio.ensure_future(self.get_files_by_keywords_page(keywords, page_size))
+        while page is not None:
+            result = await page
+            if result == config.ACCESS_DENIED:
+                raise Exception(config.ACCESS_DENIED)
+            files, cursor = result
+            page = None
+            if cursor is not None:
+                page = asyncio.ensure_future(self.get_files_by_keywords_page(keywords, page_size, cursor))
+            for file in files:
+                yield file
+
+    async def _decrypt_files(self, search_results, CTi_serialized):
+        """
+        Decrypt the encrypted data `E(R)` returned by the server, one batch per consultant request
+        :return: List of the decrypted files, in the order of the search results
+        """
+        search_results = list(search_results)
+        batches = [search_results[i:i + self.batch_size] for i in range(0, len(search_results), self.batch_size)]
+        decrypted = await asyncio.gather(*(self._run(self.client._decrypt_files, batch, CTi_serialized)
+                                           for batch in batches))
+        return [file for files in decrypted for file in files]
+
+    def close(self):
+        self.executor.shutdown()
@@ -1,21 +1,108 @@
+import io
+import itertools
+import multiprocessing
+import os
 import random
 import threading
 import uuid
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial, wraps
 
 import rpyc
 from charm.toolbox.pairinggroup import G1, pair
-from numpy.polynomial.polynomial import polyfromroots
 from rpyc.utils.authenticators import SSLAuthenticator
 from rpyc.utils.server import ThreadedServer
 
 import config
+from connection_pool import ConnectionPool
+from document_cache import DocumentCache, document_digest
 from funcs import *
+from polynomial import poly_from_roots
 from serialization import *
+import wire
 import time
 
 
 # DEBUG
 
+# Client of an upload worker process, see `Client.upload_files`
+_upload_client = None
+
+
+def _init_upload_worker(PKs, SKg, signingkey, client_id):
+    global _upload_client
+    _upload_client = Client.__new__(Client)
+    _upload_client.PKs = deserialize_PKs(PKs)
+    _upload_client.SKg = deserialize_SKg(SKg, _upload_client.PKs)
+    _upload_client.signingkey = ECC.import_key(signingkey)
+    _upload_client.id = client_id
+    _upload_client.keyword_roots = {}
+    _upload_client._precompute_fixed_bases()
+
+
+def _prepare_upload(document):
+    file_contents, keywords = document
+    return _upload_client._prepare_upload(file_contents, keywords, _upload_client.id)
+
+
+class _RemoteWriter(io.RawIOBase):
+    """
+    Writes to an upload on the server, see `Server.exposed_begin_upload`, and hashes what is written
+    """
+
+    def __init__(self, upload):
+        self.upload = upload
+        self.hash = SHA512.new()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self.upload.write(data)
+        self.hash.update(data)
+        return len(data)
+
+
+class _RemoteReader(io.RawIOBase):
+    """
+    Reads from a document on the server, see `Server.exposed_open_document`
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.reader.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def connect(ip: str, port: int):
+    """
+    Open a connection to the server or the consultant
+    """
+    return rpyc.ssl_connect(ip, port, keyfile="cert/client/key.pem", certfile="cert/client/certificate.pem",
+                            config=config.config)
+
+
+def _retry_denied(method):
+    """
+    Retry a request once when it is denied and the client turns out to have missed a new epoch, which happens when an
+    epoch notification was lost or arrived after the request
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        epoch = self.epoch
+        result = method(self, *args, **kwargs)
+        if result == config.ACCESS_DENIED and self._refresh_epoch(epoch):
+            result = method(self, *args, **kwargs)
+        return result
+    return wrapper
+
 
 class Client(rpyc.Service):
     """
@@ -24,14 +111,22 @@ class Client(rpyc.Service):
 
     def __init__(self):
         self.signingkey = gen_signing_key()
-        self.consultant = rpyc.ssl_connect(config.CONSULTANT_IP, config.CONSULTANT_PORT, keyfile="cert/client/key.pem", certfile="cert/client/certificate.pem", config=config.config)
-        self.server = rpyc.ssl_connect(config.SERVER_IP, config.SERVER_PORT, keyfile="cert/client/key.pem", certfile="cert/client/certificate.pem", config=config.config)
-        self.PKs = deserialize_PKs(self.consultant.root.get_public_parameters())
+        self.certificate_lock = threading.RLock()
+        self.epoch_subscription_lock = threading.Lock()
+        # Connection that receives the epoch notifications, requests go through the pools
+        self.consultant = connect(config.CONSULTANT_IP, config.CONSULTANT_PORT)
+        self.consultant_pool = ConnectionPool(partial(connect, config.CONSULTANT_IP, config.CONSULTANT_PORT))
+        self.server_pool = ConnectionPool(partial(connect, config.SERVER_IP, config.SERVER_PORT))
+        self.PKs = deserialize_PKs(wire.unpack_PKs(self.consultant.root.get_public_parameters()))
         print("Enter name: ")
         name = input()
         self.id = "{} ({})".format(name,str(uuid.uuid4()))
         self.port = random.randint(1024, 65535)
         self.CTi = None
+        self.keyword_roots = {}
+        self.document_cache = DocumentCache(config.DOCUMENT_CACHE_SIZE, config.DOCUMENT_CACHE_PLAINTEXT)
+        self.subscription_server = None
+        self.subscription_lock = threading.Lock()
         # self.start_server()
         self.join_consultant()
     
@@ -56,16 +151,42 @@ class Client(rpyc.Service):
     
     def _update_certificate(self):
         assert self.CTi is not None, "Client has no certificate to update!"
-        (timestamp, t) = self.consultant.root.get_update_t(self.last_update)
-        self.last_update = timestamp
-        t = self.PKs['group'].deserialize(t)
-
-        ## Step 1
-        self.PKs['X'] = self.PKs['X'] ** t
+        with self.certificate_lock:
+            if self.epoch == self.known_epoch:
+                return
+            with self.consultant_pool.connection() as consultant:
+                (epoch, t) = consultant.root.get_update_t(self.epoch)
+            self.epoch = epoch
+            self.known_epoch = max(self.known_epoch, epoch)
+            t = self.PKs['group'].deserialize(t)
+
+            ## Step 1
+            self.PKs['X'] = self.PKs['X'] ** t
+
+            ## Step 3
+            self.CTi['ci'] = self.CTi['ci'] ** t
+
+    def _current_certificate(self):
+        """
+        Bring the certificate up to date
+        :return: The membership certificate message, see `wire.pack_CTi`
+        """
+        with self.certificate_lock:
+            self._update_certificate()
+            return wire.pack_CTi(serialize_CTi(self.CTi, self.PKs))
 
-        ## Step 3
-        self.CTi['ci'] = self.CTi['ci'] ** t
+    def _precompute_fixed_bases(self):
+        """
+        Build the fixed-base exponentiation tables of `g` and `P`. These never change and are the base of every
+        exponentiation in index, trapdoor and upload generation.
 
+        The pairing e(Q, P') only depends on `SKg`, so it is computed once with its own table, which turns the pairing
+        of every upload into a GT exponentiation. This has to be called again whenever `SKg` changes.
+        """
+        self.PKs['g'].initPP()
+        self.SKg['P'].initPP()
+        self.QPp = pair(self.SKg['Q'], self.SKg['Pp'])
+        self.QPp.initPP()
 
     def _build_index(self, L, client_id: str=None):
         """
@@ -79,27 +200,40 @@ class Client(rpyc.Service):
         if client_id is None:
             client_id = self.id
         
-        SKg = self.SKg
-        α = SKg['α']
-
-        roots = [int(α * hash_Zn(client_id, self.PKs['group']))]
+        roots = [int(self._keyword_root(client_id))]
         for i in range(1, self.PKs['l']):
             if i < len(L) + 1:
                 word = L[i-1]
                 print(word)
             else:
                 word = '⊥'
-            roots.append(int(α * hash_Zn(word, self.PKs['group'])))
+            roots.append(int(self._keyword_root(word)))
 
-        polynomial_coefficients = list(polyfromroots(roots))
+        q = int(self.PKs['q'])
+        polynomial_coefficients = poly_from_roots(roots, q)
 
         rs = num_Zn_star_not_one(self.PKs['q'], self.PKs['group'].random, ZR)
+        rs = int(rs)
 
         g = self.PKs['g']
 
-        IL = [g ** (rs * self.PKs['group'].init(ZR, i)) for i in polynomial_coefficients]
+        IL = [g ** self.PKs['group'].init(ZR, rs * c % q) for c in polynomial_coefficients]
         return IL
 
+    def _build_indexes(self, keywords, client_id: str):
+        """
+        Build the secure indexes of a document. An index holds the client id tag and at most l - 2 other keywords, so
+        the keywords are split over as many indexes as needed, which all belong to the same encrypted document.
+
+        A query matches the document when all of its keywords are in the same index, so every single keyword can be
+        found, but keywords that ended up in different indexes can not be searched for together.
+        :return: List of secure indexes `IL`
+        """
+        tag = encode_client_id(client_id)
+        per_index = self.PKs['l'] - 2
+        shards = [keywords[i:i + per_index] for i in range(0, len(keywords), per_index)] or [[]]
+        return [self._build_index(shard + [tag], client_id) for shard in shards]
+
     def index_gen(self, D, keywords, client_id):
         """
         This function makes a secure index. It takes as input:
@@ -107,14 +241,14 @@ class Client(rpyc.Service):
         o System public key `self.PKs`
         o Group secret key `self.SKg`
 
-        This function outputs secure index IR, document encryption key R and encrypted document Ed
+        This function outputs secure index IR, a list of indexes that together hold all keywords, document encryption
+        key R and encrypted document Ed
         """
         keywords = extract_keywords(keywords)
-        keywords.append(encode_client_id(client_id))
         print(keywords)
         R, Ed = encrypt_document(D)
         
-        return self._build_index(keywords, client_id), R, Ed
+        return self._build_indexes(keywords, client_id), R, Ed
 
     def data_encrypt(self, R, Ed):
         """
@@ -126,19 +260,25 @@ class Client(rpyc.Service):
 
         This function outputs encrypted data E(R)
         """
+        U, V = self._encapsulate(R)
+        Er = (U, V, Ed, sign_message(self.signingkey, Ed))
+        return Er
+
+    def _encapsulate(self, R):
+        """
+        Encrypt the data encryption key `R`
+        :return: Tuple (U, V) of the encrypted data E(R)
+        """
         group = self.PKs['group']
         q = self.PKs['q']
         P = self.SKg['P']
-        Q = self.SKg['Q']
-        Pp = self.SKg['Pp']
 
         γ = num_Zn_star_not_one(q, group.random, ZR)  # let op dit is een gamma, niet een standaard y
         U = P ** γ
 
-        V = xor(R, hash_p(pair(Q, Pp) ** γ))
-
-        Er = (U, V, Ed, sign_message(self.signingkey, Ed))
-        return Er
+        # e(Q, P')^γ, see `_precompute_fixed_bases`
+        V = xor(R, hash_p(self.QPp ** γ))
+        return U, V
 
     ###
     #  /DataGen
@@ -149,6 +289,19 @@ class Client(rpyc.Service):
     #  Retrieves the encrypted data which contains specific keywords
     ###
 
+    def _keyword_root(self, keyword: str) -> pairing.pc_element:
+        """
+        Get the polynomial root `α * H(keyword)` of a keyword. The roots are memoized, as α does not change while the
+        member is in the group.
+        """
+        root = self.keyword_roots.get(keyword)
+        if root is None:
+            if len(self.keyword_roots) >= config.KEYWORD_CACHE_SIZE:
+                self.keyword_roots.clear()
+            root = self.SKg['α'] * hash_Zn(keyword, self.PKs['group'])
+            self.keyword_roots[keyword] = root
+        return root
+
     def _trapdoor(self, Lp):
         """
         This function takes as input:
@@ -156,19 +309,23 @@ class Client(rpyc.Service):
         o System parameter PM = {`self.PKs`, `self.SKg`}
 
         This function outputs the trapdoor `TLp` of the list `Lp`
+
+        The product over the keywords of g^(ru * (α * H(w_j))^i) is computed as g^(ru * Σ_j (α * H(w_j))^i), so every
+        element of the trapdoor costs a single exponentiation.
         """
-        SKg = self.SKg
-        ru = num_Zn_star_not_one(self.PKs['q'], self.PKs['group'].random, ZR)
+        group = self.PKs['group']
+        ru = num_Zn_star_not_one(self.PKs['q'], group.random, ZR)
         T = []
         if len(Lp) > self.PKs['l']:
             raise ValueError("Length of Lp needs to be smaller than l")
+        roots = [self._keyword_root(keyword) for keyword in Lp]
+        powers = [group.init(ZR, 1) for _ in roots]
         for i in range(self.PKs['l'] + 1):
-            i = self.PKs['group'].init(ZR, i)
-            Ti = self.PKs['group'].init(G1, 1)
-            for j in range(len(Lp)):
-                Tij = self.PKs['g'] ** (ru * (SKg['α'] * hash_Zn(Lp[j], self.PKs['group'])) ** i)
-                Ti = Ti * Tij
-            T.append(Ti)
+            power_sum = group.init(ZR, 0)
+            for power in powers:
+                power_sum += power
+            T.append(self.PKs['g'] ** (ru * power_sum))
+            powers = [power * root for power, root in zip(powers, roots)]
         return T
 
     def make_trapdoor(self, Lp: List[str]):
@@ -245,44 +402,373 @@ class Client(rpyc.Service):
 
         self._update_certificate()
 
-        D = file_contents
-        IR, R, Ed = self.index_gen(D, keywords, self.id)
-        Er = self.data_encrypt(R, Ed)
-        IrSerialized = serialize_IL(IR, self.PKs)
+        IrSerialized, Er = self._prepare_upload(file_contents, keywords, self.id)
+
+        with self.server_pool.connection() as server:
+            server.root.add_file(wire.pack_upload(self.id, [(IrSerialized, Er)]))
+
+    def upload_file_stream(self, source, keywords, client_id=None):
+        """
+        Upload a file of any size, encrypting it and sending it to the server chunk by chunk
+        :param source: Binary file object to read the file from
+        :param keywords: The keywords of the file
+        :param client_id: The client id the file belongs to, by default the id of this client
+        """
+        assert self.CTi is not None, "Client needs a certificate!"
+        if client_id is None:
+            client_id = self.id
+
+        self._update_certificate()
+
+        IR = self._build_indexes(extract_keywords(keywords), client_id)
+        R = get_random_bytes(32)
+        U, V = self._encapsulate(R)
+        upload = wire.pack_stream_upload(client_id, [serialize_IL(IL, self.PKs) for IL in IR],
+                                         self.PKs['group'].serialize(U), V)
+
+        with self.server_pool.connection() as server:
+            remote = _RemoteWriter(server.root.begin_upload(upload))
+            sink = io.BufferedWriter(remote, buffer_size=config.DOCUMENT_CHUNK_SIZE)
+            encrypt_document_stream(source, sink, key=R)
+            sink.flush()
+            remote.upload.finish(sign_hash(self.signingkey, remote.hash))
+
+    def upload_files(self, documents, workers=config.UPLOAD_WORKERS, batch_size=config.UPLOAD_BATCH_SIZE):
+        """
+        Upload many files at once. The indexes and encryptions are made in a pool of worker processes, and the files
+        are sent to the server in batches, refreshing the certificate once per batch.
+        :param documents: Iterable of tuples (file_contents, keywords)
+        :param workers: The number of worker processes
+        :param batch_size: The number of files to send to the server at a time
+        """
+        assert self.CTi is not None, "Client needs a certificate!"
 
-        self.server.root.add_file(IrSerialized, serialize_Er(Er, self.PKs), self.id)
+        PKs = {k: v for k, v in serialize_PKs(self.PKs).items() if k != 'group'}
+        SKg = serialize_SKg(self.SKg, self.PKs)
+        signingkey = self.signingkey.export_key(format='PEM')
+        context = multiprocessing.get_context('spawn')
+        documents = iter(documents)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_upload_worker,
+                                 initargs=(PKs, SKg, signingkey, self.id)) as pool:
+            batch = list(itertools.islice(documents, batch_size))
+            while batch:
+                self._update_certificate()
+                upload = wire.pack_upload(self.id, list(pool.map(_prepare_upload, batch)))
+                with self.server_pool.connection() as server:
+                    server.root.add_files(upload)
+                batch = list(itertools.islice(documents, batch_size))
+
+    def _prepare_upload(self, file_contents, keywords, client_id):
+        """
+        Make the secure index and encrypted data of a file
+        :return: Tuple (IR, Er) with the serialized indexes and encrypted data
+        """
+        IR, R, Ed = self.index_gen(file_contents, keywords, client_id)
+        Er = self.data_encrypt(R, Ed)
+        return [serialize_IL(IL, self.PKs) for IL in IR], serialize_Er(Er, self.PKs)
 
     
     def get_files_by_keywords(self, keywords):
+        search = self._search_files(keywords)
+        if search == config.ACCESS_DENIED:
+            return config.ACCESS_DENIED
+        search_results, CTi_serialized = search
+        return self._decrypt_files(search_results, CTi_serialized)
+
+    @_retry_denied
+    def _search_files(self, keywords):
+        """
+        Get the encrypted files that contain the keywords from the server
+        :return: Tuple (search_results, CTi_serialized) with the encrypted files and the certificate to decrypt them
+            with, or Access Denied
+        """
         assert self.CTi is not None, "Client needs a certificate!"
-        
-        self._update_certificate()
 
-        files = []
-        group = self.PKs['group']
+        CTi_serialized = self._current_certificate()
         trapdoor = self.make_trapdoor(keywords)
-        CTi_serialized = serialize_CTi(self.CTi, self.PKs)
 
         signature = sign_message(self.signingkey, trapdoor)
 
-        search_results = self.server.root.search_index(serialize_trapdoor(trapdoor, self.PKs), CTi_serialized, signature)
+        with self.server_pool.connection() as server:
+            handles = server.root.search_ids(
+                wire.pack_query([serialize_trapdoor(trapdoor, self.PKs)], CTi_serialized, [signature]))
+            if handles == config.ACCESS_DENIED:
+                return config.ACCESS_DENIED
+            search_results = server.root.fetch_documents(handles, CTi_serialized)
         if search_results == config.ACCESS_DENIED:
             return config.ACCESS_DENIED
-        for i, result in enumerate(search_results):
-            result = deserialize_Er(result, self.PKs)
-            Up, ν = self.data_aux(result)
-            D = group.deserialize(self.consultant.root.get_decryption_key(group.serialize(Up), CTi_serialized))
+        return wire.unpack_files(search_results), CTi_serialized
+
+    def get_files_by_keywords_page(self, keywords, limit, cursor=None):
+        """
+        Get one page of the files that contain the keywords
+        :param keywords: The keywords to search for
+        :param limit: The maximum number of files on the page
+        :param cursor: The cursor returned with the previous page, None for the first page
+        :return: Tuple (files, cursor) where cursor is None after the last page, or Access Denied
+        """
+        search = self._search_files_page(keywords, limit, cursor)
+        if search == config.ACCESS_DENIED:
+            return config.ACCESS_DENIED
+        search_results, cursor, CTi_serialized = search
+        return self._decrypt_files(search_results, CTi_serialized), cursor
+
+    @_retry_denied
+    def _search_files_page(self, keywords, limit, cursor=None):
+        """
+        Get one page of the encrypted files that contain the keywords from the server
+        :return: Tuple (search_results, cursor, CTi_serialized), or Access Denied
+        """
+        assert self.CTi is not None, "Client needs a certificate!"
+
+        CTi_serialized = self._current_certificate()
+        trapdoor = self.make_trapdoor(keywords)
+
+        signature = sign_message(self.signingkey, trapdoor)
+
+        with self.server_pool.connection() as server:
+            page = server.root.search_page(
+                wire.pack_query([serialize_trapdoor(trapdoor, self.PKs)], CTi_serialized, [signature]), limit, cursor)
+            if page == config.ACCESS_DENIED:
+                return config.ACCESS_DENIED
+            handles, cursor = page
+            search_results = server.root.fetch_documents(handles, CTi_serialized)
+        if search_results == config.ACCESS_DENIED:
+            return config.ACCESS_DENIED
+        return wire.unpack_files(search_results), cursor, CTi_serialized
+
+    def iter_files_by_keywords(self, keywords, page_size=config.PAGE_SIZE):
+        """
+        Iterate over the files that contain the keywords, fetching them from the server one page at a time
+        :param keywords: The keywords to search for
+        :param page_size: The number of files to fetch at a time
+        """
+        cursor = None
+        while True:
+            page = self.get_files_by_keywords_page(keywords, page_size, cursor)
+            if page == config.ACCESS_DENIED:
+                raise Exception(config.ACCESS_DENIED)
+            files, cursor = page
+            yield from files
+            if cursor is None:
+                return
+
+    @_retry_denied
+    def get_files_by_keyword_lists(self, keyword_lists):
+        """
+        Search for several keyword lists at once, the server scans its indexes only once for all of them
+        :param keyword_lists: List of keyword lists
+        :return: For every keyword list the list of matching files, or Access Denied
+        """
+        assert self.CTi is not None, "Client needs a certificate!"
+
+        CTi_serialized = self._current_certificate()
+        trapdoors = [self.make_trapdoor(keywords) for keywords in keyword_lists]
+
+        signatures = tuple(sign_message(self.signingkey, trapdoor) for trapdoor in trapdoors)
+
+        serialized_trapdoors = [serialize_trapdoor(trapdoor, self.PKs) for trapdoor in trapdoors]
+        with self.server_pool.connection() as server:
+            handle_lists = server.root.search_many(wire.pack_query(serialized_trapdoors, CTi_serialized, signatures))
+            if handle_lists == config.ACCESS_DENIED:
+                return config.ACCESS_DENIED
+            search_result_lists = [server.root.fetch_documents(handles, CTi_serialized) for handles in handle_lists]
+        if config.ACCESS_DENIED in search_result_lists:
+            return config.ACCESS_DENIED
+        return [self._decrypt_files(wire.unpack_files(search_results), CTi_serialized)
+                for search_results in search_result_lists]
+
+    @_retry_denied
+    def save_files_by_keywords(self, keywords, directory: str):
+        """
+        Save the files that contain the keywords in a directory, reading and decrypting them from the server chunk by
+        chunk
+        :param keywords: The keywords to search for
+        :param directory: The directory to save the files in
+        :return: The paths of the saved files, or Access Denied
+        """
+        assert self.CTi is not None, "Client needs a certificate!"
+
+        CTi_serialized = self._current_certificate()
+        trapdoor = self.make_trapdoor(keywords)
+
+        signature = sign_message(self.signingkey, trapdoor)
+
+        paths = []
+        with self.server_pool.connection() as server:
+            handles = server.root.search_ids(
+                wire.pack_query([serialize_trapdoor(trapdoor, self.PKs)], CTi_serialized, [signature]))
+            if handles == config.ACCESS_DENIED:
+                return config.ACCESS_DENIED
+            for handle in handles:
+                document = server.root.open_document(handle, CTi_serialized)
+                if document == config.ACCESS_DENIED:
+                    return config.ACCESS_DENIED
+                U, V, reader = document
+                Er = (self.PKs['group'].deserialize(U), V, None)
+                Up, ν = self.data_aux(Er)
+                R, _Ed = self.member_decrypt(Er, self._get_decryption_key(Up, CTi_serialized), ν)
+
+                path = os.path.join(directory, handle.hex())
+                source = io.BufferedReader(_RemoteReader(reader), buffer_size=config.DOCUMENT_CHUNK_SIZE)
+                try:
+                    with open(path, 'wb') as sink:
+                        decrypt_document_stream(R, source, sink)
+                except ValueError:
+                    os.remove(path)
+                    raise
+                paths.append(path)
+        return paths
+
+    @_retry_denied
+    def subscribe(self, keywords, callback=None):
+        """
+        Register a standing query on the server, which queues the files with the keywords that are added from now on
+        :param keywords: The keywords to watch for
+        :param callback: Function that is called in a background thread with the subscription id when new files match,
+            None to only poll them with `poll_subscription`
+        :return: The subscription id, or Access Denied
+        """
+        assert self.CTi is not None, "Client needs a certificate!"
+
+        CTi_serialized = self._current_certificate()
+        trapdoor = self.make_trapdoor(keywords)
+
+        signature = sign_message(self.signingkey, trapdoor)
+
+        return self._subscription_connection().root.subscribe(
+            wire.pack_query([serialize_trapdoor(trapdoor, self.PKs)], CTi_serialized, [signature]), callback)
+
+    @_retry_denied
+    def poll_subscription(self, subscription_id: bytes):
+        """
+        Get the files that matched a standing query since the last poll
+        :param subscription_id: The subscription id returned by `subscribe`
+        :return: List of the decrypted files, or Access Denied
+        """
+        CTi_serialized = self._current_certificate()
+        server = self._subscription_connection()
+        handles = server.root.poll_subscription(subscription_id, CTi_serialized)
+        if handles == config.ACCESS_DENIED:
+            return config.ACCESS_DENIED
+        if not handles:
+            return []
+        search_results = server.root.fetch_documents(handles, CTi_serialized)
+        if search_results == config.ACCESS_DENIED:
+            return config.ACCESS_DENIED
+        return self._decrypt_files(wire.unpack_files(search_results), CTi_serialized)
+
+    def unsubscribe(self, subscription_id: bytes):
+        self._subscription_connection().root.unsubscribe(subscription_id)
+
+    def _subscription_connection(self):
+        """
+        The connection of the standing queries. A standing query is kept by the server process that registered it, so
+        all its requests go through this connection, which also serves the callbacks.
+        """
+        with self.subscription_lock:
+            if self.subscription_server is None:
+                self.subscription_server = connect(config.SERVER_IP, config.SERVER_PORT)
+                self.subscription_thread = rpyc.BgServingThread(self.subscription_server)
+            return self.subscription_server
+
+    def _get_decryption_key(self, Up, CTi_serialized):
+        """
+        Get the decryption key `D` for the auxiliary information `Up` from the consultant
+        """
+        group = self.PKs['group']
+        with self.consultant_pool.connection() as consultant:
+            return group.deserialize(consultant.root.get_decryption_key(group.serialize(Up), CTi_serialized))
+
+    def _get_decryption_keys(self, Ups, CTi_serialized):
+        """
+        Get the decryption keys `D` for several auxiliary informations `Up` from the consultant in a single request
+        """
+        if not Ups:
+            return []
+        group = self.PKs['group']
+        with self.consultant_pool.connection() as consultant:
+            Ds = consultant.root.get_decryption_keys(tuple(group.serialize(Up) for Up in Ups), CTi_serialized)
+        return [group.deserialize(D) for D in Ds]
+
+    def _decrypt_files(self, search_results, CTi_serialized):
+        """
+        Decrypt the encrypted data `E(R)` returned by the server. The documents in the document cache are decrypted
+        without a decryption key, the others get their keys in one consultant request.
+        :param search_results: The encrypted data
+        :param CTi_serialized: The membership certificate message, see `wire.pack_CTi`
+        :return: List of the decrypted files
+        """
+        search_results = list(search_results)
+        digests = [document_digest(*result) for result in search_results]
+        files = [None] * len(search_results)
+        missing = []
+        for i, (digest, (_U, _V, Ed)) in enumerate(zip(digests, search_results)):
+            cached = self.document_cache.get(digest)
+            if cached is None:
+                missing.append(i)
+                continue
+            R, document = cached
+            files[i] = document if document is not None else decrypt_document(R, Ed)
+
+        if not missing:
+            return files
+        results = [deserialize_Er(search_results[i], self.PKs) for i in missing]
+        auxiliary = [self.data_aux(result) for result in results]
+        Ds = self._get_decryption_keys([Up for Up, _ν in auxiliary], CTi_serialized)
+
+        for i, result, (_Up, ν), D in zip(missing, results, auxiliary, Ds):
             Rp, Ed = self.member_decrypt(result, D, ν)
-            files.append(decrypt_document(Rp, Ed))
+            files[i] = decrypt_document(Rp, Ed)
+            self.document_cache.put(digests[i], Rp, files[i])
         return files
 
     
     def join_consultant(self):
         assert self.CTi is None, "Client already has a certificate!"
-        serialized_cti, serialized_skg = self.consultant.root.join(self.port, self.id, serialize_public_key(self.signingkey.public_key()))
-        self.SKg = deserialize_SKg(serialized_skg, self.PKs)
-        self.CTi = deserialize_CTi(serialized_cti, self.PKs)
-        self.last_update = time.time()
+        serialized_cti, serialized_skg, epoch = self.consultant.root.join(self.port, self.id, serialize_public_key(self.signingkey.public_key()))
+        self.SKg = deserialize_SKg(wire.unpack_SKg(serialized_skg), self.PKs)
+        self.keyword_roots = {}
+        self._precompute_fixed_bases()
+        self.CTi = deserialize_CTi(wire.unpack_CTi(serialized_cti), self.PKs)
+        self.epoch = epoch
+        self.known_epoch = epoch
+        self._subscribe_epochs()
+
+    def _subscribe_epochs(self):
+        """
+        Subscribe to the epoch notifications on `self.consultant`
+        """
+        self.consultant.root.subscribe_epoch(self._on_new_epoch)
+        self.consultant_thread = rpyc.BgServingThread(self.consultant)
+        # Epochs that started between joining and subscribing are not pushed
+        self._on_new_epoch(self.consultant.root.get_epoch())
+
+    def _refresh_epoch(self, epoch: int) -> bool:
+        """
+        Ask the consultant for the current epoch instead of waiting for a notification, and subscribe to the
+        notifications again if their connection was lost
+        :param epoch: The epoch of the certificate that was denied
+        :return: True if there is a newer epoch than `epoch`
+        """
+        with self.epoch_subscription_lock:
+            if self.consultant.closed:
+                self.consultant = connect(config.CONSULTANT_IP, config.CONSULTANT_PORT)
+                self._subscribe_epochs()
+        # The connection goes back to the pool before the certificate lock is taken, `_update_certificate` takes them
+        # the other way around
+        with self.consultant_pool.connection() as consultant:
+            current = consultant.root.get_epoch()
+        self._on_new_epoch(current)
+        with self.certificate_lock:
+            return self.known_epoch > epoch
+
+    def _on_new_epoch(self, epoch: int):
+        """
+        Called by the consultant after every join and leave
+        """
+        with self.certificate_lock:
+            self.known_epoch = max(self.known_epoch, epoch)
 
     def start_server(self):
         authenticator = SSLAuthenticator("cert/client/key.pem","cert/client/certificate.pem")
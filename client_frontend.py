@@ -12,7 +12,7 @@ client = Client()
 def upload():
     f = request.files.get('file')
     keywords = request.form['keywords']
-    client.upload_file(f.read(), keywords)
+    client.upload_file_stream(f.stream, keywords)
     return 'upload successful'
 
 
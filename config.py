@@ -1,3 +1,5 @@
+import os
+
 SERVER_IP = 'localhost'
 CONSULTANT_IP = 'localhost'
 
@@ -7,3 +9,52 @@ CONSULTANT_PORT = 8001
 config = {"allow_pickle": True, "allow_all_attrs": True, "allow_delattr": True, "allow_setattr": True}
 
 ACCESS_DENIED = "Access Denied"
+
+# Maximum size in bytes of the deserialized secure indexes the server keeps in memory, divided over the scan workers
+INDEX_CACHE_SIZE = 256 * 1024 * 1024
+
+# Number of processes the server uses to scan the secure indexes, 1 scans them in the server process
+SCAN_WORKERS = os.cpu_count() or 1
+
+# Number of documents the scan workers test at a time in a paged search
+SCAN_CHUNK_SIZE = 1024
+
+# Number of files per page when iterating over search results
+PAGE_SIZE = 20
+
+# Maximum number of keyword hashes a client keeps in memory
+KEYWORD_CACHE_SIZE = 100000
+
+# Maximum size in bytes of the decrypted documents a client keeps in memory
+DOCUMENT_CACHE_SIZE = 64 * 1024 * 1024
+
+# Whether a client caches the decrypted documents, otherwise only their keys are cached
+DOCUMENT_CACHE_PLAINTEXT = True
+
+# Number of processes a client uses to prepare files in a bulk upload
+UPLOAD_WORKERS = os.cpu_count() or 1
+
+# Number of files a client sends to the server at a time in a bulk upload
+UPLOAD_BATCH_SIZE = 100
+
+# Maximum number of connections a client keeps open to the server and to the consultant each
+CONNECTION_POOL_SIZE = 8
+
+# Number of seconds a pooled connection can be idle before it is checked with a ping
+CONNECTION_IDLE_CHECK = 30
+
+# Number of search results the asyncio client decrypts per consultant request
+DECRYPTION_BATCH_SIZE = 8
+
+# Number of processes that serve the server's connections, each with its own threads
+SERVER_PROCESSES = 1
+
+# Number of bytes per encrypted chunk of a document, and per request when streaming a document to or from the server
+DOCUMENT_CHUNK_SIZE = 1024 * 1024
+
+# Number of seconds between the syncs of a server process that has standing queries, which match the documents that
+# other server processes added
+SUBSCRIPTION_SYNC_INTERVAL = 5
+
+# Maximum number of unpolled documents a standing query queues, a query that queues more is removed
+SUBSCRIPTION_QUEUE_SIZE = 10000
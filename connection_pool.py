@@ -0,0 +1,75 @@
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import config
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of rpyc connections.
+
+    Connections are opened when they are needed, up to `size` at a time, and handed to one thread at a time. A
+    connection that has been idle for a while is pinged before it is handed out, and a connection that is closed or
+    breaks while in use is dropped, so the next checkout opens a new one.
+    """
+
+    def __init__(self, connect, size: int = config.CONNECTION_POOL_SIZE,
+                 idle_check: float = config.CONNECTION_IDLE_CHECK):
+        """
+        :param connect: Function that opens a new connection
+        :param size: The maximum number of connections
+        :param idle_check: Number of seconds a connection can be idle before it is pinged at checkout
+        """
+        self.connect = connect
+        self.size = size
+        self.idle_check = idle_check
+        # Tuples (last used, connection), the most recently used connection is handed out first
+        self._idle = queue.LifoQueue()
+        self._available = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        """
+        Check out a connection, blocking while all connections are in use
+        """
+        with self._available:
+            connection = self._checkout()
+            try:
+                yield connection
+            except EOFError:
+                connection.close()
+                raise
+            finally:
+                if not connection.closed:
+                    self._idle.put((time.monotonic(), connection))
+
+    def _checkout(self):
+        while True:
+            try:
+                last_used, connection = self._idle.get_nowait()
+            except queue.Empty:
+                return self.connect()
+            if self._healthy(connection, last_used):
+                return connection
+            connection.close()
+
+    def _healthy(self, connection, last_used: float) -> bool:
+        if connection.closed:
+            return False
+        if time.monotonic() - last_used < self.idle_check:
+            return True
+        try:
+            connection.ping(timeout=self.idle_check)
+            return True
+        except Exception:
+            return False
+
+    def close(self):
+        while True:
+            try:
+                _last_used, connection = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            connection.close()
@@ -1,6 +1,7 @@
 import threading
 import traceback
 import uuid
+from functools import partial
 from socket import socket
 
 import rpyc
@@ -9,9 +10,14 @@ from rpyc.utils.authenticators import SSLAuthenticator
 from rpyc.utils.server import ThreadedServer
 
 import config
-from client import Client
+from client import Client, connect
+from connection_pool import ConnectionPool
+from errors import InputError
+from document_cache import DocumentCache
+from membership import member_check
 from funcs import *
 from serialization import *
+import wire
 import threading
 import time
 
@@ -35,17 +41,30 @@ class Consultant(Client):
         print('init')
         self.τ = τ
         self.system_setup(τ)
+        self.certificate_lock = self.lock
+        self.keyword_roots = {}
+        self.document_cache = DocumentCache(config.DOCUMENT_CACHE_SIZE, config.DOCUMENT_CACHE_PLAINTEXT)
+        self.subscription_server = None
+        self.subscription_lock = threading.Lock()
+        self._precompute_fixed_bases()
         self.G = {}
         self.signingkey = gen_signing_key()
         self.id = str(uuid.uuid4())
         self.group_auth()
 
+    def _precompute_fixed_bases(self):
+        """
+        Also compute Q^σ, which only depends on `SKg` and `MK`, so a decryption key costs one pairing and no GT
+        exponentiation.
+        """
+        super()._precompute_fixed_bases()
+        self.Qσ = self.SKg['Q'] ** self.MK['σ']
+
     def create_consultant_user(self):
         self.member_join(self)
 
     def connect_server(self):
-        self.server = rpyc.ssl_connect(config.SERVER_IP, config.SERVER_PORT, keyfile="cert/client/key.pem",
-                                       certfile="cert/client/certificate.pem", config=config.config)
+        self.server_pool = ConnectionPool(partial(connect, config.SERVER_IP, config.SERVER_PORT))
 
     def system_setup(self, τ):
         """
@@ -67,8 +86,11 @@ class Consultant(Client):
         self.PKs = {'l': 21, 'curve': curve, 'secparam': τ, 'group': group, 'q': q, 'g': g, 'X': X, 'Y': Y}
         self.SKg = {'α': α, 'P': P, 'Pp': Pp, 'Q': Q, 'Qp': Qp}
         self.MK = {'x': x, 'y': y, 'λ': λ, 'σ': σ}
-        self.t = 1
-        self.ts = []
+        self.t = group.init(ZR, 1)
+        # Log of the product of all t up to every epoch, the update from epoch i to epoch j is epochs[j] / epochs[i]
+        self.epochs = [self.t]
+        self.epoch_listeners = []
+        self.lock = threading.RLock()
         # a = pair(g1**2, g2**3)
         # b = pair(g1, g2) ** 6
         # group.init(ZR, 10)
@@ -97,15 +119,38 @@ class Consultant(Client):
         ci = ai ** (x + hash_Zn(self.id, group) * x * y)
 
         self.CTi = {'IDi': self.id, 'ai': ai, 'bi': bi, 'ci': ci}
+        # The ai of every certificate, to keep them unique
+        self.ais = {group.serialize(ai)}
 
         ## Step 2: keep CTi secret!
 
     def _check_unique_ai(self, ai):
         """ Returns True if ai is unique (does not exist already), false if it is not. """
-        for M in self.G.values():
-            if M.CTi['ai'] == ai:
-                return False
-        return True
+        return self.PKs['group'].serialize(ai) not in self.ais
+
+    @property
+    def epoch(self) -> int:
+        return len(self.epochs) - 1
+
+    def _new_epoch(self, t):
+        """
+        Update X and the consultant's own certificate with `t`, and log the update as a new epoch
+        """
+        self.PKs['X'] = self.PKs['X'] ** t
+        self.CTi['ci'] = self.CTi['ci'] ** t
+        self.t *= t
+        self.epochs.append(self.t)
+
+    def _notify_epoch(self):
+        """
+        Push the current epoch to the subscribed clients, so they only request an update when something changed
+        """
+        epoch = self.epoch
+        for listener in list(self.epoch_listeners):
+            try:
+                rpyc.async_(listener)(epoch)
+            except EOFError:
+                self.epoch_listeners.remove(listener)
 
     def member_join(self, M):
         """
@@ -119,29 +164,44 @@ class Consultant(Client):
         This function outputs Membership certificates {CT_N+i}; 1 <= i <= N for all newly joining members, updated
         membership certificates for the old members {M_i}; 1 <= i <= N, and an updated parameter of the system public key PKs.
         """
+        return self.member_join_many([M])[0]
+
+    def member_join_many(self, Ms):
+        """
+        Let several new members join the group at once, with a single update of the system public key.
+
+        Returns for every member its membership certificate message, or None if it already is a member.
+        """
         group = self.PKs['group']
         q = self.PKs['q']
-        X = self.PKs['X']
 
         x = self.MK['x']
         y = self.MK['y']
 
-        if M.id not in self.G:
-            print(self.G.keys())
-            print(M.id)
-            ## Step 1
-            t = num_Zn_star_not_one(q, group.random, ZR)
-            self.PKs['X'] = X ** t
-            self.CTi['ci'] = self.CTi['ci'] ** t
-            self.t *= t
-            self.ts.append((time.time(), t))
-
-            if not hasattr(self, 'server'):
-                self.connect_server()
-            self.server.root.update_public_key(group.serialize(t))
-            self.server.root.add_client(M.id, serialize_public_key(M.public_key))
-
-            ## Step 2
+        new_members = {}
+        for M in Ms:
+            if M.id not in self.G and M.id not in new_members:
+                new_members[M.id] = M
+        new_members = list(new_members.values())
+        if not new_members:
+            return [None for _ in Ms]
+
+        print(self.G.keys())
+        print([M.id for M in new_members])
+        ## Step 1
+        t = num_Zn_star_not_one(q, group.random, ZR)
+
+        # X is only updated here once the server has updated it, so a failed request leaves them equal
+        if not hasattr(self, 'server_pool'):
+            self.connect_server()
+        with self.server_pool.connection() as server:
+            server.root.add_clients(tuple((M.id, serialize_public_key(M.public_key)) for M in new_members))
+            server.root.update_public_key(group.serialize(t))
+        self._new_epoch(t)
+        self._notify_epoch()
+
+        ## Step 2
+        for M in new_members:
             ai = group.random(G1)
             while (not self._check_unique_ai(ai)):
                 ai = group.random(G1)
@@ -150,15 +210,15 @@ class Consultant(Client):
 
             CTi = {'IDi': M.id, 'ai': ai, 'bi': bi, 'ci': ci}
             M.CTi = CTi
-            print("sending CTi")
+            self.ais.add(group.serialize(ai))
 
             # Add the new members to the member group
             self.G[M.id] = M
+        print("sending CTi")
+
+        joined = set(map(id, new_members))
+        return [wire.pack_CTi(serialize_CTi(M.CTi, self.PKs)) if id(M) in joined else None for M in Ms]
 
-            return serialize_CTi(M.CTi, self.PKs)
-        else:
-            return None
-        
         ## Step 3: let old members update ci, we do this already in member.update_certificate
 
         ## Step 4: new members keep CTi secret!
@@ -174,23 +234,37 @@ class Consultant(Client):
         This function outputs updates membership certificates for the remaining members, and an updated parameter
         of the system public key PKs.
         """
+        self.member_leave_many([M])
+
+    def member_leave_many(self, Ms):
+        """
+        Let several members leave the group at once, with a single update of the system public key.
+        """
         group = self.PKs['group']
         q = self.PKs['q']
-        X = self.PKs['X']
+
+        leaving_members = {}
+        for M in Ms:
+            if M.id not in self.G:
+                raise InputError('{} is not a member'.format(M.id))
+            leaving_members[M.id] = M
+        if not leaving_members:
+            return
 
         ## Step 1
         t = num_Zn_star_not_one(q, group.random, ZR)
-        self.PKs['X'] = X ** t
-        self.CTi['ci'] = self.CTi['ci'] ** t
-        self.t *= t
-        self.ts.append((time.time(), t))
-
-        t = group.serialize(t)
-        del self.G[M.id]
 
-        if not hasattr(self, 'server'):
+        # X is only updated here once the server has updated it, so a failed request leaves them equal
+        if not hasattr(self, 'server_pool'):
             self.connect_server()
-        self.server.root.update_public_key(t)
+        with self.server_pool.connection() as server:
+            server.root.update_public_key(group.serialize(t))
+        self._new_epoch(t)
+
+        for M in leaving_members.values():
+            del self.G[M.id]
+            self.ais.discard(group.serialize(M.CTi['ai']))
+        self._notify_epoch()
 
         ## Step 2: let remaining members update ci, we do this already in member.update_certificate
 
@@ -215,20 +289,18 @@ class Consultant(Client):
 
         This functions outputs the decryption key `D` or Access Denied for the member.
         """
-        X = self.PKs['X']
-        Y = self.PKs['Y']
-        g = self.PKs['g']
-        group = self.PKs['group']
+        return self.get_decryption_keys([Up], CTi)[0]
 
-        Q = self.SKg['Q']
-        σ = self.MK['σ']
-
-        member = pair(CTi['ai'], Y) == pair(g, CTi['bi']) and \
-                 pair(X, CTi['ai']) * pair(X, CTi['bi']) ** hash_Zn(CTi['IDi'], group) == pair(g, CTi['ci'])
+    def get_decryption_keys(self, Ups, CTi):
+        """
+        Make the decryption keys for several auxiliary informations `Up` of the same member, checking the membership
+        only once.
 
-        if member:
-            D = pair(Q, Up) ** σ
-            return D
+        This functions outputs the list of decryption keys `D` or Access Denied for the member.
+        """
+        if member_check(CTi, self.PKs):
+            # e(Q, Up)^σ == e(Q^σ, Up), see `_precompute_fixed_bases`
+            return [pair(self.Qσ, Up) for Up in Ups]
         else:
             raise Exception("Access Denied")
 
@@ -241,38 +313,50 @@ class Consultant(Client):
 
     def upload_file(self, file_contents, keywords, client_id):
         assert self.CTi is not None, "Consultant needs a certificate!"
-        assert hasattr(self, 'server'), "Server has not yet been initialized!"
+        assert hasattr(self, 'server_pool'), "Server has not yet been initialized!"
 
-        D = file_contents
-        IR, R, Ed = self.index_gen(D, keywords, client_id)
-        Er = self.data_encrypt(R, Ed)
-        IrSerialized = serialize_IL(IR, self.PKs)
+        IrSerialized, Er = self._prepare_upload(file_contents, keywords, client_id)
 
-        self.server.root.add_file(IrSerialized, serialize_Er(Er, self.PKs), client_id)
+        with self.server_pool.connection() as server:
+            server.root.add_file(wire.pack_upload(client_id, [(IrSerialized, Er)]))
 
-    def get_files_by_keywords(self, keywords):
+    def get_files_by_keywords(self, keywords, client_id=None):
+        """
+        Search the files of all clients, or only those of `client_id`
+        """
         assert self.CTi is not None, "Consultant needs a certificate!"
-        assert hasattr(self, 'server'), "Server has not yet been initialized!"
+        assert hasattr(self, 'server_pool'), "Server has not yet been initialized!"
 
-        files = []
-        group = self.PKs['group']
+        if client_id is not None:
+            keywords = keywords + [encode_client_id(client_id)]
         trapdoor = self.make_trapdoor(keywords)
-        CTi_serialized = serialize_CTi(self.CTi, self.PKs)
+        CTi_serialized = self._current_certificate()
 
         signature = sign_message(self.signingkey, trapdoor)
 
-        search_results = self.server.root.search_index(serialize_trapdoor(trapdoor, self.PKs), CTi_serialized,
-                                                       signature)
+        with self.server_pool.connection() as server:
+            handles = server.root.search_ids(
+                wire.pack_query([serialize_trapdoor(trapdoor, self.PKs)], CTi_serialized, [signature], client_id))
+            if handles == config.ACCESS_DENIED:
+                return config.ACCESS_DENIED
+            search_results = server.root.fetch_documents(handles, CTi_serialized)
         if search_results == config.ACCESS_DENIED:
             return config.ACCESS_DENIED
-        for i, result in enumerate(search_results):
-            result = deserialize_Er(result, self.PKs)
-            Up, ν = self.data_aux(result)
-            # D = group.deserialize(self.consultant.root.get_decryption_key(group.serialize(Up), CTi_serialized))
-            D = self.get_decryption_key(Up, self.CTi)
-            Rp, Ed = self.member_decrypt(result, D, ν)
-            files.append(decrypt_document(Rp, Ed))
-        return files
+        return self._decrypt_files(wire.unpack_files(search_results), CTi_serialized)
+
+    def _update_certificate(self):
+        # The consultant updates its own certificate on every join and leave
+        pass
+
+    def _refresh_epoch(self, epoch: int) -> bool:
+        # The certificate of the consultant is always up to date
+        return False
+
+    def _get_decryption_key(self, Up, CTi_serialized):
+        return self.get_decryption_key(Up, self.CTi)
+
+    def _get_decryption_keys(self, Ups, CTi_serialized):
+        return self.get_decryption_keys(Ups, self.CTi)
 
 
 class ConsultantServer(rpyc.Service):
@@ -286,43 +370,94 @@ class ConsultantServer(rpyc.Service):
 
     def exposed_get_public_parameters(self):
         print("get public parameters")
-        return serialize_PKs(self.consultant.PKs)
+        return wire.pack_PKs(serialize_PKs(self.consultant.PKs))
 
     def exposed_get_public_key(self):
         print("get public key")
         return serialize_public_key(self.consultant.signingkey.public_key())
     
-    def exposed_get_update_t(self, last_update: float):
-        update = (time.time(), self.consultant.PKs['group'].init(ZR, 1))
-        for (timestamp, t) in filter(lambda x: x[0] > last_update, self.consultant.ts):
-            update = (timestamp, update[1] * t)
-        update = (update[0], self.consultant.PKs['group'].serialize(update[1]))
-        return update
+    def exposed_get_epoch(self) -> int:
+        return self.consultant.epoch
+
+    def exposed_subscribe_epoch(self, callback):
+        """
+        Subscribe to new epochs, `callback` is called with the new epoch after every join and leave
+        """
+        self.consultant.epoch_listeners.append(callback)
+
+    def exposed_get_update_t(self, epoch: int):
+        """
+        Get the update of the certificate from `epoch` to the current epoch
+        :return: Tuple (current epoch, t)
+        """
+        consultant = self.consultant
+        with consultant.lock:
+            current = consultant.epoch
+            if not 0 <= epoch <= current:
+                raise InputError('Unknown epoch {}'.format(epoch))
+            t = consultant.epochs[current] / consultant.epochs[epoch]
+        return current, consultant.PKs['group'].serialize(t)
 
     def exposed_join(self, port, id, public_key: bytes):
         print("join")
         client = self.consultant.G.get(id, ConsultantClient(self.ip, port, id, deserialize_public_key(public_key)))
         try:
-            serialized_cti = self.consultant.member_join(client)
-            SKg = serialize_SKg(self.consultant.SKg, self.consultant.PKs)
-            return serialized_cti, SKg
+            with self.consultant.lock:
+                serialized_cti = self.consultant.member_join(client)
+                epoch = self.consultant.epoch
+            SKg = wire.pack_SKg(serialize_SKg(self.consultant.SKg, self.consultant.PKs))
+            return serialized_cti, SKg, epoch
         except Exception:
             traceback.print_exc()
 
+    def exposed_join_many(self, members):
+        """
+        Let several members join at once, with a single key update
+        :param members: List of tuples (id, public_key)
+        :return: Tuple (certificates, SKg, epoch) with the serialized certificate of every member, None for members
+        that already joined
+        """
+        print("join many")
+        clients = [self.consultant.G.get(id, ConsultantClient(self.ip, None, id, deserialize_public_key(public_key)))
+                   for id, public_key in members]
+        with self.consultant.lock:
+            serialized_ctis = self.consultant.member_join_many(clients)
+            epoch = self.consultant.epoch
+        SKg = wire.pack_SKg(serialize_SKg(self.consultant.SKg, self.consultant.PKs))
+        return tuple(serialized_ctis), SKg, epoch
+
     def exposed_leave(self, id):
         print("leave")
         member = self.consultant.G[id]
         assert member is not None
-        self.consultant.member_leave(member)
+        with self.consultant.lock:
+            self.consultant.member_leave(member)
+
+    def exposed_leave_many(self, ids):
+        """
+        Let several members leave at once, with a single key update
+        """
+        print("leave many")
+        members = [self.consultant.G[id] for id in ids]
+        with self.consultant.lock:
+            self.consultant.member_leave_many(members)
 
     def exposed_get_decryption_key(self, Up, CTi):
         print("get decryption key")
         PKs = self.consultant.PKs
-        CTi = deserialize_CTi(CTi, PKs)
+        CTi = deserialize_CTi(wire.unpack_CTi(CTi), PKs)
         Up = PKs['group'].deserialize(Up)
         D = self.consultant.get_decryption_key(Up, CTi)
         return PKs['group'].serialize(D)
 
+    def exposed_get_decryption_keys(self, Ups, CTi):
+        print("get decryption keys")
+        PKs = self.consultant.PKs
+        CTi = deserialize_CTi(wire.unpack_CTi(CTi), PKs)
+        Ups = [PKs['group'].deserialize(Up) for Up in Ups]
+        Ds = self.consultant.get_decryption_keys(Ups, CTi)
+        return tuple(PKs['group'].serialize(D) for D in Ds)
+
     def start_server(self):
         authenticator = SSLAuthenticator("cert/consultant/key.pem", "cert/consultant/certificate.pem")
         server = ThreadedServer(self, port=8001, protocol_config=config.config, authenticator=authenticator)
@@ -14,8 +14,8 @@ def upload():
         f = request.files.get('file')
         keywords = request.form['keywords']
         client = request.form['clientID']
-        consultant_server.consultant.upload_file(f.read(), keywords,
-                                                 client)  # TODO should throw an error if no client id.
+        consultant_server.consultant.upload_file_stream(f.stream, keywords,
+                                                        client)  # TODO should throw an error if no client id.
         return 'upload successful'
     except Exception as e:
         print(e)
@@ -27,11 +27,11 @@ def search():
     query = request.args['q']
     query = query.split(' ')
     client = request.args['clientID']
-    if client != "all clients":
-        query.append(encode_client_id(client))
+    if client == "all clients":
+        client = None
     print(query)
     try:
-        result = consultant_server.consultant.get_files_by_keywords(query)  # TODO make search for client.id
+        result = consultant_server.consultant.get_files_by_keywords(query, client)
     except KeyError as k:
         result = "Search word {} is not a keyword".format(str(k))
     except Exception as e:
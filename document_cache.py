@@ -0,0 +1,128 @@
+import hashlib
+import io
+import struct
+import threading
+from collections import OrderedDict
+
+from funcs import decrypt_document_stream, encrypt_document_stream, read_full
+
+# digest, document key, plaintext flag, plaintext length
+ENTRY = struct.Struct('<32s32sBQ')
+
+
+def document_digest(U: bytes, V: bytes, Ed: bytes) -> bytes:
+    """
+    Digest of an encrypted file as returned by the server
+    :param U: The serialized U
+    :param V: V of the encrypted file
+    :param Ed: The encrypted document
+    """
+    h = hashlib.sha256()
+    for part in (U, V, Ed):
+        h.update(struct.pack('<Q', len(part)))
+        h.update(part)
+    return h.digest()
+
+
+class DocumentCache:
+    """
+    Memory-bounded LRU cache of the documents a client has decrypted, keyed by the digest of the encrypted file. It
+    holds the document key `R` and, if enabled, the plaintext, so a document that is found again needs no decryption
+    key from the consultant and no pairing.
+    """
+
+    def __init__(self, max_bytes: int, keep_plaintext: bool = True):
+        """
+        :param max_bytes: The maximum size of the cached keys and plaintexts, in bytes
+        :param keep_plaintext: Whether to cache the plaintexts, otherwise only the keys are cached and the documents
+        are decrypted again with them
+        """
+        self.max_bytes = max_bytes
+        self.keep_plaintext = keep_plaintext
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, digest):
+        return digest in self._entries
+
+    def get(self, digest: bytes):
+        """
+        Get a cached document
+        :param digest: The digest of the encrypted file, see `document_digest`
+        :return: Tuple (R, plaintext) where plaintext is None when it is not cached, or None when the document is not
+        cached
+        """
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            self._entries.move_to_end(digest)
+            R, plaintext, _size = entry
+            return R, plaintext
+
+    def put(self, digest: bytes, R: bytes, plaintext: bytes = None):
+        """
+        Add a document to the cache, evicting the least recently used documents when the cache is full
+        :param digest: The digest of the encrypted file, see `document_digest`
+        :param R: The document key
+        :param plaintext: The decrypted document
+        """
+        # A plaintext that does not fit is left out, its key still saves the consultant request
+        if not self.keep_plaintext or ENTRY.size + len(plaintext or b'') > self.max_bytes:
+            plaintext = None
+        size = ENTRY.size + (0 if plaintext is None else len(plaintext))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(digest, None)
+            if old is not None:
+                self.size -= old[2]
+            self._entries[digest] = (R, plaintext, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _digest, (_R, _plaintext, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def save(self, path: str, key: bytes):
+        """
+        Save the cache encrypted to a file
+        :param path: The path of the file
+        :param key: The 32 byte key to encrypt the file with
+        """
+        with self._lock:
+            entries = list(self._entries.items())
+        data = io.BytesIO()
+        for digest, (R, plaintext, _size) in entries:
+            data.write(ENTRY.pack(digest, R, plaintext is not None, 0 if plaintext is None else len(plaintext)))
+            if plaintext is not None:
+                data.write(plaintext)
+        data.seek(0)
+        with open(path, 'wb') as sink:
+            encrypt_document_stream(data, sink, key=key)
+
+    def load(self, path: str, key: bytes):
+        """
+        Add the documents of a file made by `save` to the cache. Raises ValueError when the file is not authentic.
+        :param path: The path of the file
+        :param key: The key the file was encrypted with
+        """
+        data = io.BytesIO()
+        with open(path, 'rb') as source:
+            decrypt_document_stream(key, source, data)
+        data.seek(0)
+        while True:
+            header = read_full(data, ENTRY.size)
+            if not header:
+                return
+            digest, R, has_plaintext, length = ENTRY.unpack(header)
+            plaintext = read_full(data, length) if has_plaintext else None
+            self.put(digest, R, plaintext)
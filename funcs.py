@@ -2,7 +2,9 @@ from fractions import gcd
 import charm.core.math.pairing as pairing
 from charm.toolbox.pairinggroup import PairingGroup, ZR, H, hashPair
 import hashlib
+import io
 import math
+import struct
 from typing import SupportsFloat, List, Union
 
 from Crypto.Random import get_random_bytes
@@ -12,6 +14,18 @@ from Crypto.Signature import DSS
 from Crypto.PublicKey import ECC
 import base64
 
+import config
+
+# Documents are encrypted in chunks, so they can be encrypted and decrypted as a stream. The header holds the chunk
+# size and a random nonce prefix, the nonce of a chunk is the prefix followed by the chunk index. Every chunk is
+# authenticated together with a flag that marks the last chunk, so chunks can not be reordered, dropped or cut off.
+DOCUMENT_MAGIC = b'SDMD\x01'
+DOCUMENT_HEADER = struct.Struct('<I8s')
+# ciphertext length, last chunk flag
+CHUNK_HEADER = struct.Struct('<IB')
+CHUNK_INDEX = struct.Struct('<Q')
+TAG_SIZE = 16
+
 def num_Zn_star(n, fun, *args):
     """
     Random number in the multiplicative group of integers modulo n
@@ -66,28 +80,6 @@ def xor(a: bytes, b: bytes) -> bytes:
     assert len(a) == len(b)
     return bytes([x ^ y for x,y in zip(a, b)])
 
-def poly_from_roots(roots):
-    mutated_roots = []
-    for root in roots:
-        mutated_roots.append([-root, 1])
-
-    if len(mutated_roots) > 1:
-        result = mutated_roots[0]
-        for i in range(1, len(mutated_roots)):
-            result = _my_poly_root_evaluation(result, mutated_roots[i])
-        return result
-    else:
-        return mutated_roots
-
-
-def _my_poly_root_evaluation(a, b):
-    c = [0] * (len(a) + len(b))
-    for i in range(len(a)):
-        for j in range(len(b)):
-            c[i + j] = c[i + j] + a[i] * b[j]
-    return c
-
-
 def read_file(path: str) -> str:
     f = open(path, 'r')
     lines = f.readlines()
@@ -117,14 +109,56 @@ def extract_keywords(doc: str) -> List[str]:
     return result
 
 
+def read_full(source, size: int) -> bytes:
+    """
+    Read `size` bytes from a file object, fewer only at the end of the file
+    """
+    parts = []
+    while size > 0:
+        part = source.read(size)
+        if not part:
+            break
+        parts.append(part)
+        size -= len(part)
+    return b''.join(parts)
+
+
 def encrypt_document(doc: bytes) -> (bytes, bytes):
+    sink = io.BytesIO()
+    key = encrypt_document_stream(io.BytesIO(doc), sink)
+    return key, sink.getvalue()
 
-    key = get_random_bytes(32)
-    cipher = AES.new(key, AES.MODE_EAX)
 
-    ciphertext, tag = cipher.encrypt_and_digest(doc)
+def encrypt_document_stream(source, sink, chunk_size: int = config.DOCUMENT_CHUNK_SIZE, key: bytes = None) -> bytes:
+    """
+    Encrypt a document chunk by chunk
+    :param source: File object to read the document from
+    :param sink: File object to write the encrypted document to
+    :param chunk_size: The number of bytes per chunk
+    :param key: The key to encrypt the document with, by default a random key
+    :return: The key of the document
+    """
+    if key is None:
+        key = get_random_bytes(32)
+    prefix = get_random_bytes(8)
+    sink.write(DOCUMENT_MAGIC + DOCUMENT_HEADER.pack(chunk_size, prefix))
 
-    return key, cipher.nonce + tag + ciphertext
+    chunk = read_full(source, chunk_size)
+    index = 0
+    while True:
+        # Read ahead to know whether this is the last chunk
+        next_chunk = read_full(source, chunk_size) if len(chunk) == chunk_size else b''
+        last = not next_chunk
+        cipher = AES.new(key, AES.MODE_EAX, nonce=prefix + CHUNK_INDEX.pack(index))
+        cipher.update(bytes([last]))
+        ciphertext, tag = cipher.encrypt_and_digest(chunk)
+        sink.write(CHUNK_HEADER.pack(len(ciphertext), last))
+        sink.write(ciphertext)
+        sink.write(tag)
+        if last:
+            return key
+        chunk = next_chunk
+        index += 1
 
 
 def gen_signing_key() -> ECC.EccKey:
@@ -132,10 +166,45 @@ def gen_signing_key() -> ECC.EccKey:
 
 
 def decrypt_document(key: bytes, ciphertext: bytes) -> str:
-    nonce, tag, ciphertext = ciphertext[:16], ciphertext[16:32], ciphertext[32:]
-    cipher = AES.new(key, AES.MODE_EAX, nonce)
-    doc = cipher.decrypt_and_verify(ciphertext, tag)
-    return doc
+    sink = io.BytesIO()
+    decrypt_document_stream(key, io.BytesIO(ciphertext), sink)
+    return sink.getvalue()
+
+
+def decrypt_document_stream(key: bytes, source, sink):
+    """
+    Decrypt a document chunk by chunk, see `encrypt_document_stream`. Raises ValueError when the document is not
+    authentic, the chunks before it have already been written to `sink` then.
+    :param key: The key of the document
+    :param source: File object to read the encrypted document from
+    :param sink: File object to write the document to
+    """
+    if read_full(source, len(DOCUMENT_MAGIC)) != DOCUMENT_MAGIC:
+        raise ValueError('Not an encrypted document')
+    header = read_full(source, DOCUMENT_HEADER.size)
+    if len(header) != DOCUMENT_HEADER.size:
+        raise ValueError('Truncated document')
+    chunk_size, prefix = DOCUMENT_HEADER.unpack(header)
+
+    index = 0
+    while True:
+        header = read_full(source, CHUNK_HEADER.size)
+        if len(header) != CHUNK_HEADER.size:
+            raise ValueError('Truncated document')
+        length, last = CHUNK_HEADER.unpack(header)
+        if length > chunk_size or last > 1:
+            raise ValueError('Invalid chunk')
+        body = read_full(source, length + TAG_SIZE)
+        if len(body) != length + TAG_SIZE:
+            raise ValueError('Truncated document')
+        cipher = AES.new(key, AES.MODE_EAX, nonce=prefix + CHUNK_INDEX.pack(index))
+        cipher.update(bytes([last]))
+        sink.write(cipher.decrypt_and_verify(body[:length], body[length:]))
+        if last:
+            if source.read(1):
+                raise ValueError('Data after the last chunk')
+            return
+        index += 1
 
 
 def trapdoor_to_bytes(trapdoor: List[pairing.pc_element]) -> bytes:
@@ -152,7 +221,13 @@ def sign_message(key, message: Union[bytes, List[pairing.pc_element]]) -> bytes:
     if isinstance(message, list):
         message = trapdoor_to_bytes(message)
 
-    h = SHA512.new(message)
+    return sign_hash(key, SHA512.new(message))
+
+
+def sign_hash(key, h) -> bytes:
+    """
+    Sign a message that was hashed incrementally with `SHA512.new()`
+    """
     signer = DSS.new(key, 'fips-186-3')
     return signer.sign(h)
 
@@ -161,7 +236,13 @@ def verify_message(pubkey, message: Union[bytes, List[pairing.pc_element]], sign
     if isinstance(message, list):
         message = trapdoor_to_bytes(message)
         
-    h = SHA512.new(message)
+    return verify_hash(pubkey, SHA512.new(message), signature)
+
+
+def verify_hash(pubkey, h, signature: bytes) -> bool:
+    """
+    Verify the signature of a message that was hashed incrementally with `SHA512.new()`
+    """
     verifier = DSS.new(pubkey, 'fips-186-3')
     try:
         verifier.verify(h, signature)
@@ -171,7 +252,3 @@ def verify_message(pubkey, message: Union[bytes, List[pairing.pc_element]], sign
 
 def encode_client_id(client_id):
     return base64.b64encode(client_id.encode()).decode()
-
-if __name__ == '__main__':
-    print(poly_from_roots([6, 2, 3]))
-    print(poly_from_roots([2, 3]))
@@ -0,0 +1,72 @@
+import threading
+from collections import OrderedDict
+
+
+class IndexCache:
+    """
+    Memory-bounded LRU cache of deserialized secure indexes, keyed by document id
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        :param max_bytes: The maximum (serialized) size of the cached indexes, in bytes
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._entries
+
+    def get(self, doc_id):
+        """
+        Get a cached index
+        :param doc_id: The document id of the index
+        :return: Tuple (client_id, IL) or None when the index is not cached
+        """
+        with self._lock:
+            entry = self._entries.get(doc_id)
+            if entry is None:
+                return None
+            self._entries.move_to_end(doc_id)
+            client_id, IL, _size = entry
+            return client_id, IL
+
+    def put(self, doc_id, client_id, IL, size: int):
+        """
+        Add an index to the cache, evicting the least recently used indexes when the cache is full
+        :param doc_id: The document id of the index
+        :param client_id: The client id the document belongs to
+        :param IL: The deserialized secure index
+        :param size: The serialized size of the index, used to account for its memory usage
+        """
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(doc_id, None)
+            if old is not None:
+                self.size -= old[2]
+            self._entries[doc_id] = (client_id, IL, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _doc_id, (_client_id, _IL, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def discard(self, doc_id):
+        """
+        Remove an index from the cache if it is present
+        :param doc_id: The document id of the index
+        """
+        with self._lock:
+            entry = self._entries.pop(doc_id, None)
+            if entry is not None:
+                self.size -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
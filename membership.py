@@ -0,0 +1,31 @@
+from charm.toolbox.pairinggroup import ZR, GT
+
+from funcs import hash_Zn, num_Zn_star_not_one
+
+
+def member_check(CTi, PKs, X=None) -> bool:
+    """
+    Check the membership of a certificate, which holds when
+        e(ai, Y) == e(g, bi)  and  e(X, ai) * e(X, bi)^H(IDi) == e(g, ci)
+
+    Both equations are checked at once as the product of pairings
+        e(ai^r, Y) * e(X, ai * bi^H(IDi)) * e(g^-1, bi^r * ci) == 1
+    for a random r, which only costs three Miller loops and a single final exponentiation. If either equation does
+    not hold, the product is 1 with negligible probability.
+
+    :param CTi: Deserialized membership certificate
+    :param PKs: The system's public parameters
+    :param X: The X to check against, by default the X of `PKs`
+    :return: True if the certificate is valid
+    """
+    group = PKs['group']
+    if X is None:
+        X = PKs['X']
+    Y = PKs['Y']
+    g = PKs['g']
+    ai, bi, ci = CTi['ai'], CTi['bi'], CTi['ci']
+
+    r = num_Zn_star_not_one(PKs['q'], group.random, ZR)
+    V = group.pair_prod([ai ** r, X, g ** -1],
+                        [Y, ai * bi ** hash_Zn(CTi['IDi'], group), bi ** r * ci])
+    return V == group.init(GT, 1)
@@ -0,0 +1,183 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from charm.toolbox.pairinggroup import PairingGroup, GT
+
+from index_cache import IndexCache
+from segment_store import PartitionedStore
+
+# State of a scan worker process: its own pairing group, its own view of the document store, the cache of its
+# deserialized indexes and its shard of document ids, by client id
+_group = None
+_store = None
+_index_cache = None
+_shard = {}
+_shard_doc_ids = set()
+# Documents whose index could not be read, they never match
+_unreadable = set()
+
+
+def _init_worker(curve, secparam, directory, cache_size):
+    global _group, _store, _index_cache
+    _group = PairingGroup(curve, secparam=secparam)
+    _store = PartitionedStore(directory)
+    _index_cache = IndexCache(cache_size)
+
+
+def _add_documents(documents):
+    """
+    Add documents to the shard of this worker, deserializing their indexes while the index cache has room. Documents
+    that are already in the shard are skipped, so a batch can be added again.
+    :param documents: List of tuples (doc_id, client_id)
+    """
+    _store.refresh()
+    for doc_id, client_id in documents:
+        if doc_id in _shard_doc_ids:
+            continue
+        _shard_doc_ids.add(doc_id)
+        _shard.setdefault(client_id, []).append(doc_id)
+        if _index_cache.size < _index_cache.max_bytes:
+            _load_index(doc_id)
+
+
+def _load_index(doc_id):
+    """
+    Get the deserialized secure index of a document, from the index cache if possible
+    :param doc_id: The id of the document
+    :return: The deserialized secure index, None if it can not be read
+    """
+    if doc_id in _unreadable:
+        return None
+    entry = _index_cache.get(doc_id)
+    if entry is not None:
+        return entry[1]
+    client_id, IR = _store.read_index(doc_id)
+    try:
+        IL = [_group.deserialize(x) for x in IR]
+    except Exception:
+        IL = None
+    if IL is None or any(x is None for x in IL):
+        # One bad index should not fail every scan, the document is left out of the results instead
+        _unreadable.add(doc_id)
+        return None
+    _index_cache.put(doc_id, client_id, IL, sum(len(x) for x in IR))
+    return IL
+
+
+def in_scope(scope, client_id) -> bool:
+    """
+    Check whether a document of a client falls in the scope of a trapdoor
+    :param scope: The set of client ids the trapdoor may match, None for all clients
+    :param client_id: The client id of the document
+    """
+    return scope is None or client_id in scope
+
+
+def scopes_client_ids(scopes):
+    """
+    Get the client ids whose documents fall in the scope of any of the trapdoors
+    :param scopes: The scopes of the trapdoors
+    :return: Set of client ids, None when a trapdoor may match the documents of all clients
+    """
+    client_ids = set()
+    for scope in scopes:
+        if scope is None:
+            return None
+        client_ids |= scope
+    return client_ids
+
+
+def index_matches(group, TLp, IL) -> bool:
+    """
+    Test whether a document matches a trapdoor. The index of a document is the concatenation of one or more indexes of
+    the length of the trapdoor, the document matches when any of them does. The test stops at the first match.
+    :param group: The pairing group
+    :param TLp: Trapdoor
+    :param IL: Secure index of the document
+    """
+    n = len(TLp)
+    assert len(IL) % n == 0, "Length of trapdoor and index do not match!"
+    identity = group.init(GT, 1)
+    return any(group.pair_prod(TLp, IL[i:i + n]) == identity for i in range(0, len(IL), n))
+
+
+def _scan_shard(trapdoors, scopes, start, stop):
+    """
+    Test the indexes in the shard of this worker against the trapdoors
+    :param trapdoors: List of serialized trapdoors
+    :param scopes: For every trapdoor the client ids whose documents it may match
+    :param start: The first document id to test
+    :param stop: The document id to stop before
+    :return: For every trapdoor the list of matching document ids
+    """
+    result = [[] for _ in trapdoors]
+    queries = [([_group.deserialize(x) for x in TLp], scope, doc_ids)
+               for TLp, scope, doc_ids in zip(trapdoors, scopes, result) if scope != frozenset()]
+    client_ids = scopes_client_ids(scope for _TLp, scope, _doc_ids in queries)
+    if client_ids is None:
+        client_ids = _shard.keys()
+    for client_id in client_ids:
+        for doc_id in _shard.get(client_id, ()):
+            if not start <= doc_id < stop:
+                continue
+            IL = _load_index(doc_id)
+            if IL is None:
+                continue
+            for TLp, scope, doc_ids in queries:
+                if in_scope(scope, client_id) and index_matches(_group, TLp, IL):
+                    doc_ids.append(doc_id)
+    return result
+
+
+class ParallelScanner:
+    """
+    Scans the secure indexes on multiple cores. The documents are divided by document id over a number of worker
+    processes, partitioned by client id. Every worker reads the indexes of its shard from the document store and keeps
+    them deserialized in its own index cache, which gets an equal part of the cache size.
+    """
+
+    def __init__(self, curve, secparam, workers: int, directory: str, cache_size: int):
+        """
+        :param curve: The curve of the system's pairing group
+        :param secparam: The security parameter of the system's pairing group
+        :param workers: The number of worker processes
+        :param directory: The directory of the document store
+        :param cache_size: The maximum size in bytes of the deserialized indexes of all workers together
+        """
+        context = multiprocessing.get_context('spawn')
+        self.workers = [ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=_init_worker,
+                                            initargs=(curve, secparam, directory, cache_size // workers))
+                        for _ in range(workers)]
+        self._lock = threading.Lock()
+
+    def add(self, documents):
+        """
+        Add documents to the shards, once they are in the document store
+        :param documents: Iterable of tuples (doc_id, client_id) with integer document ids
+        """
+        shards = [[] for _ in self.workers]
+        with self._lock:
+            for doc_id, client_id in documents:
+                shards[doc_id % len(self.workers)].append((doc_id, client_id))
+            futures = [worker.submit(_add_documents, shard) for worker, shard in zip(self.workers, shards) if shard]
+        for future in futures:
+            future.result()
+
+    def scan(self, trapdoors, scopes, start: int, stop: int):
+        """
+        Test the indexes against the trapdoors in one pass
+        :param trapdoors: List of serialized trapdoors
+        :param scopes: For every trapdoor the client ids whose documents it may match, None for all clients
+        :param start: The first document id to test
+        :param stop: The document id to stop before
+        :return: For every trapdoor the list of matching document ids, in document order
+        """
+        trapdoors = [list(TLp) for TLp in trapdoors]
+        futures = [worker.submit(_scan_shard, trapdoors, scopes, start, stop) for worker in self.workers]
+        shard_results = [future.result() for future in futures]
+        return [sorted(doc_id for result in shard_results for doc_id in result[i]) for i in range(len(trapdoors))]
+
+    def close(self):
+        for worker in self.workers:
+            worker.shutdown()
@@ -0,0 +1,58 @@
+from typing import List
+
+# Below this number of coefficients schoolbook multiplication is faster than Kronecker substitution
+SCHOOLBOOK_THRESHOLD = 16
+
+
+def _poly_mul_schoolbook(a: List[int], b: List[int], q: int) -> List[int]:
+    c = [0] * (len(a) + len(b) - 1)
+    for i, x in enumerate(a):
+        for j, y in enumerate(b):
+            c[i + j] += x * y
+    return [x % q for x in c]
+
+
+def _pack(a: List[int], width: int) -> int:
+    return int.from_bytes(b''.join(x.to_bytes(width, 'little') for x in a), 'little')
+
+
+def _unpack(x: int, width: int, n: int) -> List[int]:
+    data = x.to_bytes(width * n, 'little')
+    return [int.from_bytes(data[i * width:(i + 1) * width], 'little') for i in range(n)]
+
+
+def poly_mul(a: List[int], b: List[int], q: int) -> List[int]:
+    """
+    Multiply two polynomials over Z_q
+    :param a: Coefficients of the first polynomial, lowest degree first, reduced modulo q
+    :param b: Coefficients of the second polynomial, lowest degree first, reduced modulo q
+    :param q: The modulus
+    :return: Coefficients of the product, lowest degree first, reduced modulo q
+    """
+    if min(len(a), len(b)) < SCHOOLBOOK_THRESHOLD:
+        return _poly_mul_schoolbook(a, b, q)
+
+    # Kronecker substitution: evaluate both polynomials at a power of two that is larger than every coefficient of
+    # the product, so a single (sub-quadratic) big integer multiplication computes all of them
+    n = len(a) + len(b) - 1
+    bits = 2 * (q - 1).bit_length() + min(len(a), len(b)).bit_length()
+    width = (bits + 7) // 8
+    product = _pack(a, width) * _pack(b, width)
+    return [x % q for x in _unpack(product, width, n)]
+
+
+def poly_from_roots(roots: List[int], q: int) -> List[int]:
+    """
+    Compute the monic polynomial with the given roots over Z_q, by multiplying the factors (x - root) in a product
+    tree
+    :param roots: The roots
+    :param q: The modulus
+    :return: Coefficients of the polynomial, lowest degree first, reduced modulo q
+    """
+    if not roots:
+        return [1]
+    factors = [[-root % q, 1] for root in roots]
+    while len(factors) > 1:
+        factors = [poly_mul(factors[i], factors[i + 1], q) if i + 1 < len(factors) else factors[i]
+                   for i in range(0, len(factors), 2)]
+    return factors[0]
@@ -0,0 +1,354 @@
+import bisect
+import fcntl
+import hashlib
+import heapq
+import mmap
+import io
+import os
+import shutil
+import struct
+import threading
+from array import array
+
+from errors import InputError
+from wire import point_from_bytes, point_to_bytes
+
+SEGMENT_FILE = 'documents.seg'
+OFFSET_FILE = 'documents.off'
+BLOB_FILE = 'documents.blob'
+
+MAGIC = b'SDMS\x03'
+# client id length, number of index points, point width, blob offset, blob length
+RECORD_HEADER = struct.Struct('<HIHQQ')
+# U width, V length, Er length
+BLOB_HEADER = struct.Struct('<HIQ')
+OFFSET = struct.Struct('<Q')
+# Number of bytes to copy at a time when appending an encrypted document from a file
+COPY_SIZE = 1024 * 1024
+
+class SegmentStore:
+    """
+    Append-only binary store of the documents on the server.
+
+    The index records are appended to a segment file that is read through mmap. A record holds the client id, the
+    secure index as fixed-width compressed points and the location of the encrypted file in the blob file. An offset
+    table holds the position of every record, the document id of a record is its position in the offset table.
+
+    The encrypted files are kept apart in the blob file: U as compressed point followed by V and Er. They are only read
+    when a document is fetched, so scanning the index never touches them.
+    """
+
+    def __init__(self, directory: str):
+        """
+        Open the store in a directory, creating it if it does not exist yet
+        :param directory: The directory of the store
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._segment = open(os.path.join(directory, SEGMENT_FILE), 'a+b')
+        self._offset_file = open(os.path.join(directory, OFFSET_FILE), 'a+b')
+        self._blob_file = open(os.path.join(directory, BLOB_FILE), 'a+b')
+        self._lock = threading.Lock()
+        self._map = None
+
+        self._segment.seek(0, os.SEEK_END)
+        if self._segment.tell() == 0:
+            self._segment.write(MAGIC)
+            self._segment.flush()
+        else:
+            self._segment.seek(0)
+            if self._segment.read(len(MAGIC)) != MAGIC:
+                raise ValueError('{} is not a document segment'.format(self._segment.name))
+
+        self.offsets = array('Q')
+        self.refresh()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def refresh(self):
+        """
+        Read the offsets of the records that were appended by other processes
+        """
+        with self._lock:
+            fileno = self._offset_file.fileno()
+            position = len(self.offsets) * OFFSET.size
+            data = os.pread(fileno, os.fstat(fileno).st_size - position, position)
+            # An offset that is still being written is read on the next refresh
+            self.offsets.frombytes(data[:len(data) - len(data) % OFFSET.size])
+
+    def append(self, client_id: str, IR, U: bytes, V: bytes, Er) -> int:
+        """
+        Append a document to the store
+        :param client_id: The client id the document belongs to
+        :param IR: The serialized secure index
+        :param U: The serialized U of the encrypted file
+        :param V: V of the encrypted file
+        :param Er: The encrypted document, as bytes or as a file object that is copied from its start
+        :return: The document id
+        """
+        client_id = client_id.encode()
+        points = [point_to_bytes(x) for x in IR]
+        U = point_to_bytes(U)
+        width = len(U)
+        if any(len(x) != width for x in points):
+            raise InputError('Points should have a fixed width')
+
+        if isinstance(Er, bytes):
+            Er = io.BytesIO(Er)
+        Er_length = Er.seek(0, os.SEEK_END)
+        Er.seek(0)
+        header = b''.join([BLOB_HEADER.pack(width, len(V), Er_length), U, V])
+        blob_length = len(header) + Er_length
+
+        with self._lock:
+            self._blob_file.seek(0, os.SEEK_END)
+            blob_offset = self._blob_file.tell()
+            self._blob_file.write(header)
+            shutil.copyfileobj(Er, self._blob_file, COPY_SIZE)
+            self._blob_file.flush()
+
+            record = b''.join([RECORD_HEADER.pack(len(client_id), len(points), width, blob_offset, blob_length),
+                               client_id] + points)
+            self._segment.seek(0, os.SEEK_END)
+            offset = self._segment.tell()
+            self._segment.write(record)
+            self._segment.flush()
+
+            self._offset_file.write(OFFSET.pack(offset))
+            self._offset_file.flush()
+            self.offsets.append(offset)
+            return len(self.offsets) - 1
+
+    def _record(self, doc_id: int):
+        """
+        Parse an index record
+        :param doc_id: The document id of the record
+        :return: Tuple (client_id, IR, blob offset, blob length), where IR holds views of the raw points
+        """
+        offset = self.offsets[doc_id]
+        view = memoryview(self._mapped(offset + RECORD_HEADER.size))
+        client_id_length, n, width, blob_offset, blob_length = RECORD_HEADER.unpack_from(view, offset)
+        position = offset + RECORD_HEADER.size
+        end = position + client_id_length + n * width
+        if end > len(view):
+            view = memoryview(self._mapped(end))
+
+        client_id = bytes(view[position:position + client_id_length]).decode()
+        position += client_id_length
+        IR = [view[position + i * width:position + (i + 1) * width] for i in range(n)]
+        return client_id, IR, blob_offset, blob_length
+
+    def read_index(self, doc_id: int):
+        """
+        Read the secure index of a document
+        :param doc_id: The document id
+        :return: Tuple (client_id, IR) with the serialized secure index
+        """
+        client_id, IR, _blob_offset, _blob_length = self._record(doc_id)
+        return client_id, [point_from_bytes(x) for x in IR]
+
+    def read_client_id(self, doc_id: int) -> str:
+        """
+        Read the client id a document belongs to
+        :param doc_id: The document id
+        """
+        client_id, _IR, _blob_offset, _blob_length = self._record(doc_id)
+        return client_id
+
+    def read_file(self, doc_id: int):
+        """
+        Read the encrypted file of a document from the blob file
+        :param doc_id: The document id
+        :return: The file as a tuple (U, V, Er)
+        """
+        _client_id, _IR, blob_offset, blob_length = self._record(doc_id)
+        blob = memoryview(os.pread(self._blob_file.fileno(), blob_length, blob_offset))
+        width, V_length, Er_length = BLOB_HEADER.unpack_from(blob)
+        position = BLOB_HEADER.size
+        U = point_from_bytes(blob[position:position + width])
+        position += width
+        V = bytes(blob[position:position + V_length])
+        position += V_length
+        Er = bytes(blob[position:position + Er_length])
+        return U, V, Er
+
+    def _blob_header(self, doc_id: int):
+        """
+        :return: Tuple (blob offset, U width, V length, Er length)
+        """
+        _client_id, _IR, blob_offset, _blob_length = self._record(doc_id)
+        header = os.pread(self._blob_file.fileno(), BLOB_HEADER.size, blob_offset)
+        return (blob_offset,) + BLOB_HEADER.unpack(header)
+
+    def read_file_header(self, doc_id: int):
+        """
+        Read the encrypted file of a document without the encrypted document itself
+        :param doc_id: The document id
+        :return: Tuple (U, V, Er length)
+        """
+        blob_offset, width, V_length, Er_length = self._blob_header(doc_id)
+        data = os.pread(self._blob_file.fileno(), width + V_length, blob_offset + BLOB_HEADER.size)
+        return point_from_bytes(data[:width]), data[width:], Er_length
+
+    def read_file_range(self, doc_id: int, offset: int, size: int) -> bytes:
+        """
+        Read part of the encrypted document of a document
+        :param doc_id: The document id
+        :param offset: The position in the encrypted document to start reading at
+        :param size: The maximum number of bytes to read
+        :return: The bytes read, empty at the end of the encrypted document
+        """
+        blob_offset, width, V_length, Er_length = self._blob_header(doc_id)
+        size = max(0, min(size, Er_length - offset))
+        return os.pread(self._blob_file.fileno(), size, blob_offset + BLOB_HEADER.size + width + V_length + offset)
+
+    def _mapped(self, size: int) -> mmap.mmap:
+        """
+        Get a read-only map of the segment that is at least `size` bytes long, remapping it if the segment has grown
+        """
+        current = self._map
+        if current is None or len(current) < size:
+            with self._lock:
+                if self._map is None or len(self._map) < size:
+                    self._map = mmap.mmap(self._segment.fileno(), 0, access=mmap.ACCESS_READ)
+                current = self._map
+        return current
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self._segment.close()
+        self._offset_file.close()
+        self._blob_file.close()
+
+
+LOCK_FILE = 'documents.lock'
+
+
+def partition_key(client_id: str) -> bytes:
+    return hashlib.sha256(client_id.encode()).digest()[:8]
+
+
+class PartitionedStore:
+    """
+    Document store that is partitioned by client id, so the documents of one client can be scanned without touching
+    those of other clients.
+
+    All documents are kept in one `SegmentStore`, so the number of open files does not grow with the number of
+    clients. The partitions are only lists of document ids, built from the client ids in the records.
+
+    Several processes can share the store. Appends hold a lock on a lock file, and the documents appended by other
+    processes are registered by `refresh`.
+    """
+
+    def __init__(self, directory: str):
+        """
+        Open the store in a directory, creating it if it does not exist yet
+        :param directory: The directory of the store
+        """
+        self.directory = directory
+        self.segment = SegmentStore(directory)
+        self._lock_file = open(os.path.join(directory, LOCK_FILE), 'a+b')
+        self._lock = threading.Lock()
+        # Document ids of every partition, in document order
+        self.partition_doc_ids = {}
+        # Partition key of every document
+        self.entries = []
+        self.refresh()
+
+    def _register(self, key: bytes):
+        self.partition_doc_ids.setdefault(key, array('Q')).append(len(self.entries))
+        self.entries.append(key)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def refresh(self):
+        """
+        Register the documents that were appended by other processes
+        """
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self):
+        self.segment.refresh()
+        for doc_id in range(len(self.entries), len(self.segment)):
+            self._register(partition_key(self.segment.read_client_id(doc_id)))
+
+    def append(self, client_id: str, IR, U: bytes, V: bytes, Er) -> int:
+        """
+        Append a document to the partition of its client
+        :param client_id: The client id the document belongs to
+        :param IR: The serialized secure index
+        :param U: The serialized U of the encrypted file
+        :param V: V of the encrypted file
+        :param Er: The encrypted document, as bytes or as a file object that is copied from its start
+        :return: The document id
+        """
+        key = partition_key(client_id)
+        with self._lock:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                # The segment has to know the records of other processes before appending to it
+                self._refresh()
+                doc_id = self.segment.append(client_id, IR, U, V, Er)
+                self._register(key)
+                return doc_id
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def doc_ids(self, client_ids=None, start: int = 0, stop: int = None):
+        """
+        Get the document ids of some partitions
+        :param client_ids: The client ids of the partitions, None for all documents
+        :param start: The first document id to include
+        :param stop: The document id to stop before, None to include the last document
+        :return: Iterable of document ids, in document order
+        """
+        if stop is None:
+            stop = len(self.entries)
+        if client_ids is None:
+            return range(start, stop)
+
+        partitions = []
+        for key in {partition_key(client_id) for client_id in client_ids}:
+            doc_ids = self.partition_doc_ids.get(key)
+            if doc_ids:
+                partitions.append(doc_ids[bisect.bisect_left(doc_ids, start):bisect.bisect_left(doc_ids, stop)])
+        return heapq.merge(*partitions)
+
+    def read_index(self, doc_id: int):
+        """
+        Read the secure index of a document, see `SegmentStore.read_index`
+        """
+        return self.segment.read_index(doc_id)
+
+    def read_client_id(self, doc_id: int) -> str:
+        """
+        Read the client id a document belongs to
+        """
+        return self.segment.read_client_id(doc_id)
+
+    def read_file(self, doc_id: int):
+        """
+        Read the encrypted file of a document, see `SegmentStore.read_file`
+        """
+        return self.segment.read_file(doc_id)
+
+    def read_file_header(self, doc_id: int):
+        """
+        Read the encrypted file of a document without the encrypted document itself, see
+        `SegmentStore.read_file_header`
+        """
+        return self.segment.read_file_header(doc_id)
+
+    def read_file_range(self, doc_id: int, offset: int, size: int) -> bytes:
+        """
+        Read part of the encrypted document of a document, see `SegmentStore.read_file_range`
+        """
+        return self.segment.read_file_range(doc_id, offset, size)
+
+    def close(self):
+        self.segment.close()
+        self._lock_file.close()
@@ -13,7 +13,7 @@ def deserialize_PKs(_PKs):
     PKs['group'] = PairingGroup(_PKs['curve'], secparam=_PKs['secparam'])
     for k in ['g', 'X', 'Y']:
         PKs[k] = PKs['group'].deserialize(_PKs[k])
-    for k in ['l', 'q']:
+    for k in ['l', 'q', 'curve', 'secparam']:
         PKs[k] = _PKs[k]
     return PKs
 
@@ -1,21 +1,47 @@
+import hmac
+import hashlib
 import os
 import shutil
+import signal
+import struct
+import tempfile
+import threading
 
 import rpyc
 from charm.toolbox.pairinggroup import GT, pair, G1
 from charm.core.math.pairing import serialize, deserialize
 import Crypto
+from Crypto.Hash import SHA512
 
 from funcs import *
 from rpyc.utils.authenticators import SSLAuthenticator
-from rpyc.utils.server import ThreadedServer  # or ForkingServer
+from rpyc.utils.server import ThreadedServer
 import config
-import json
-import base64
+import membership
 from serialization import *
 from errors import *
+from index_cache import IndexCache
+from parallel_scan import ParallelScanner, in_scope, index_matches, scopes_client_ids
+from segment_store import PartitionedStore
+from shared_state import StateLog
+import wire
 
 FILE_DIRECTORY = 'documents'
+STATE_FILE = 'server.state'
+
+# Kinds of the records in the state log
+CLIENT_RECORD = 1
+X_RECORD = 2
+# client id length, followed by the client id and the public key
+CLIENT = struct.Struct('<H')
+
+# Document id followed by a MAC binding it to the member that searched for it, used for document handles and cursors
+HANDLE = struct.Struct('<Q16s')
+DOCUMENT_HANDLE = b'document'
+CURSOR = b'cursor'
+
+# Random subscription ids, which only the member that registered a standing query knows
+SUBSCRIPTION_ID_SIZE = 16
 
 
 class Server(rpyc.Service):
@@ -23,56 +49,198 @@ class Server(rpyc.Service):
     This is the server (honest but curious)
     """
 
-    def __init__(self, _PKs, _consultant_public_key):
+    def __init__(self, _PKs, _consultant_public_key, scan_workers=config.SCAN_WORKERS, handle_key=None):
         """
-        The constructor of the server object
+        The constructor of the server object. Several server processes can share the document store and the state in
+        the state log, every process constructs its own server object.
         :param _PKs: The system's public parameters
         :param _consultant_public_key: The public key of the systems consultant
+        :param scan_workers: The number of processes that scan the secure indexes, 1 scans them in this process
+        :param handle_key: The key of the document handles and cursors, which is the same for all server processes.
+        By default a random key.
         """
         self.PKs = _PKs
         self.file_directory = FILE_DIRECTORY
-        self._create_documents_folder()
+        self.store = PartitionedStore(self.file_directory)
+        self.state = StateLog(os.path.join(self.file_directory, STATE_FILE))
         self.client_public_keys = {}
         self.consultant_public_key = _consultant_public_key
+        self.handle_key = os.urandom(32) if handle_key is None else handle_key
+        self.index_cache = IndexCache(config.INDEX_CACHE_SIZE)
+        # Certificates that passed the membership check since the last update of X
+        self.verified_certificates = set()
+        self.X_epoch = 0
+        self._certificate_lock = threading.Lock()
+        self.scanner = None
+        # Number of documents that were handed to the scan workers
+        self.scanned_documents = 0
+        self._scanner_lock = threading.Lock()
+        # Standing queries by subscription id, they are kept by the process that registered them
+        self.subscriptions = {}
+        # Number of documents that were tested against the standing queries
+        self.matched_documents = 0
+        self._subscription_lock = threading.Lock()
+        self._subscription_sync = None
+        self._closed = threading.Event()
+        # The connection whose requests the current thread serves, see `on_connect`
+        self._connection = threading.local()
+        if scan_workers > 1:
+            self.scanner = ParallelScanner(self.PKs['curve'], self.PKs['secparam'], scan_workers, self.file_directory,
+                                           config.INDEX_CACHE_SIZE)
+        self._sync()
 
-    def _create_documents_folder(self):
+    def on_connect(self, conn):
+        # ThreadedServer serves every connection in the thread that connected it
+        self._connection.conn = conn
+
+    def on_disconnect(self, conn):
+        with self._subscription_lock:
+            for subscription_id, subscription in list(self.subscriptions.items()):
+                if subscription.connection is conn:
+                    del self.subscriptions[subscription_id]
+
+    def _sync(self):
         """
-        Helper function to create the directory where the files need to be stored
+        Apply the changes that other server processes made to the state and the document store
         """
-        if not os.path.exists(self.file_directory):
-            os.makedirs(self.file_directory)
+        self._sync_state()
+        self.store.refresh()
+        self._sync_scanner()
+        self._match_subscriptions()
+
+    def _sync_state(self):
+        with self.state.lock:
+            for kind, payload in self.state.read():
+                if kind == CLIENT_RECORD:
+                    length, = CLIENT.unpack_from(payload)
+                    client_id = payload[CLIENT.size:CLIENT.size + length].decode()
+                    public_key = deserialize_public_key(payload[CLIENT.size + length:])
+                    self.client_public_keys.setdefault(client_id, public_key)
+                elif kind == X_RECORD:
+                    with self._certificate_lock:
+                        self.PKs['X'] = self.PKs['group'].deserialize(payload)
+                        self.X_epoch += 1
+                        self.verified_certificates.clear()
+
+    def _sync_scanner(self):
+        """
+        Hand the documents that were added since the last sync to the scan workers
+        """
+        if self.scanner is None:
+            return
+        with self._scanner_lock:
+            end = len(self.store)
+            self.scanner.add((doc_id, self.store.read_client_id(doc_id))
+                             for doc_id in range(self.scanned_documents, end))
+            self.scanned_documents = end
 
     def exposed_update_public_key(self, t):
         t = self.PKs['group'].deserialize(t)
-        self.PKs['X'] = self.PKs['X'] ** t
+        with self.state.locked():
+            self._sync_state()
+            self.state.append(X_RECORD, self.PKs['group'].serialize(self.PKs['X'] ** t))
+            self._sync_state()
 
-    def exposed_add_file(self, IR, file, client_id):
+    def exposed_add_file(self, upload: bytes):
         """
         Add a client-generated index and encrypted file to the server
-        :param IR: The searchable indexes
-        :param file: The file object, containing U, V, Er, and signature
-        :param client_id: The client id for which the file needs to be added
+        :param upload: Upload message with the client id for which the file needs to be added, the searchable index and
+        the file object, containing U, V, Er, and signature, see `wire.pack_upload`
         """
+        client_id, files = wire.unpack_upload(upload)
+        if len(files) != 1:
+            raise InputError('The upload should have a single file')
+        self._add_files(files, client_id)
 
-        U, V, Er, signature = file
-        IR = [base64.b64encode(x).decode('ascii') for x in IR]
+    def exposed_add_files(self, upload: bytes):
+        """
+        Add several client-generated indexes and encrypted files to the server at once. No file is added if any of
+        them is invalid.
+        :param upload: Upload message with the client id and the files, see `wire.pack_upload`
+        """
+        client_id, files = wire.unpack_upload(upload)
+        self._add_files(files, client_id)
 
+    def exposed_begin_upload(self, upload: bytes):
+        """
+        Start adding a file of which the encrypted document is streamed to the server in chunks
+        :param upload: Upload message with the client id, the searchable indexes, U and V, see
+        `wire.pack_stream_upload`
+        :return: The upload, to which the encrypted document is written
+        """
+        client_id, IR, U, V = wire.unpack_stream_upload(upload)
+        IL, = self._check_upload(client_id, [(IR, U)])
+        return DocumentUpload(self, client_id, IR, IL, U, V)
+
+    def _add_files(self, files, client_id):
+        ILs = self._check_upload(client_id, [(IR, U) for IR, (U, _V, _Er, _signature) in files])
+        for _IR, (U, V, Er, signature) in files:
+            self._check_signature(client_id, SHA512.new(Er), signature)
+        self._store_files(client_id, [(IR, (U, V, Er)) for IR, (U, V, Er, _signature) in files], ILs)
+
+    def _check_upload(self, client_id, files):
+        """
+        Check uploaded files before any of them is stored, so no file of an upload is stored if any of them is invalid
+        :param client_id: The client id the files belong to
+        :param files: List of tuples (IR, U) with the serialized indexes and U of every file
+        :return: For every file its deserialized index, the concatenation of its indexes
+        """
+        self._sync_state()
         if client_id not in self.client_public_keys.keys():
             raise InputError('Client ID is not found in the server\'s list of clients')
+        ILs = []
+        for IR, U in files:
+            if not IR or any(len(IL) != self.PKs['l'] + 1 for IL in IR):
+                raise InputError('Every index should have l + 1 points')
+            # The points of a document are stored with the width of U
+            width = len(wire.point_to_bytes(U))
+            self._check_point(U, width)
+            ILs.append([self._check_point(x, width) for IL in IR for x in IL])
+        return ILs
 
-        if not (verify_message(self.client_public_keys[client_id], Er, signature) or verify_message(self.consultant_public_key, Er, signature)):
-            raise InputError('The signature does not match the client ID\'s public key or the consultant\'s public key')
+    def _check_point(self, x: bytes, width: int):
+        """
+        Check an uploaded point
+        :param x: The serialized G1 element
+        :param width: The width the compressed point should have
+        :return: The deserialized element
+        """
+        if len(wire.point_to_bytes(x)) != width:
+            raise InputError('Points should have a fixed width')
+        try:
+            element = self.PKs['group'].deserialize(x)
+        except Exception:
+            element = None
+        if element is None:
+            raise InputError('Invalid point')
+        return element
 
-        file_to_save = {
-            'client_id': client_id,
-            'U': base64.b64encode(U).decode('ascii'),
-            'V': base64.b64encode(V).decode('ascii'),
-            'IR': IR,
-            'Er': base64.b64encode(Er).decode('ascii'),
-        }
+    def _check_signature(self, client_id, h, signature: bytes):
+        """
+        Check the signature of an encrypted document
+        :param client_id: The client id the document belongs to
+        :param h: SHA512 hash of the encrypted document
+        :param signature: The signature
+        """
+        if not (verify_hash(self.client_public_keys[client_id], h, signature) or verify_hash(self.consultant_public_key, h, signature)):
+            raise InputError('The signature does not match the client ID\'s public key or the consultant\'s public key')
 
-        file_name = self.file_directory + os.path.sep + str(len(next(os.walk(FILE_DIRECTORY))[2])) + '.json'
-        json.dump(file_to_save, open(file_name, 'w'), indent=4)
+    def _store_files(self, client_id, files, ILs):
+        """
+        Store checked files
+        :param client_id: The client id the files belong to
+        :param files: List of tuples (IR, (U, V, Er)), where Er is bytes or a file object
+        :param ILs: The deserialized indexes returned by `_check_upload`
+        """
+        # The indexes of a document are stored concatenated, they all have the length of a trapdoor
+        files = [([x for IL in IR for x in IL], file) for IR, file in files]
+        doc_ids = [self.store.append(client_id, IR, U, V, Er) for IR, (U, V, Er) in files]
+        if self.scanner is not None:
+            self._sync_scanner()
+        else:
+            for doc_id, (IR, _file), IL in zip(doc_ids, files, ILs):
+                self.index_cache.put(doc_id, client_id, IL, sum(len(x) for x in IR))
+        self._match_subscriptions()
 
     def exposed_add_client(self, client_id: int, public_key: bytes) -> bool:
         """
@@ -81,13 +249,24 @@ class Server(rpyc.Service):
         :param public_key: The public key to add
         :return: True if the client_id is not available yet
         """
-        public_key = deserialize_public_key(public_key)
+        deserialize_public_key(public_key)
+        encoded_id = client_id.encode()
 
-        if client_id not in self.client_public_keys:
-            self.client_public_keys[client_id] = public_key
+        with self.state.locked():
+            self._sync_state()
+            if client_id in self.client_public_keys:
+                return False
+            self.state.append(CLIENT_RECORD, CLIENT.pack(len(encoded_id)) + encoded_id + bytes(public_key))
+            self._sync_state()
             return True
-        else:
-            return False
+
+    def exposed_add_clients(self, clients):
+        """
+        Add the public keys of several clients at once
+        :param clients: List of tuples (client_id, public_key)
+        :return: For every client True if the client_id was not available yet
+        """
+        return tuple(self.exposed_add_client(client_id, public_key) for client_id, public_key in clients)
     ###
     #  DataQuery
     #  Retrieves the encrypted data which contains specific keywords
@@ -95,89 +274,538 @@ class Server(rpyc.Service):
 
     def member_check(self, CTi):
         """
-        Check the membership of a certificate
+        Check the membership of a certificate. Certificates that pass are remembered until X is updated.
         :param CTi: Membership Certificate
         :return: either Yes for access granted, or Access Denied to terminate the protocol
         """
-        X = self.PKs['X']
-        Y = self.PKs['Y']
-        g = self.PKs['g']
-        group = self.PKs['group']
-        CTi = deserialize_CTi(CTi, self.PKs)
-        member = pair(CTi['ai'], Y) == pair(g, CTi['bi']) and \
-                 pair(X, CTi['ai']) * pair(X, CTi['bi']) ** hash_Zn(CTi['IDi'], group) == pair(g, CTi['ci'])
+        certificate = (CTi['IDi'], CTi['ai'], CTi['bi'], CTi['ci'])
+        with self._certificate_lock:
+            if certificate in self.verified_certificates:
+                return True
+            X = self.PKs['X']
+            X_epoch = self.X_epoch
+
+        member = membership.member_check(deserialize_CTi(CTi, self.PKs), self.PKs, X)
+
+        if member:
+            with self._certificate_lock:
+                if self.X_epoch == X_epoch:
+                    self.verified_certificates.add(certificate)
         return member
 
-    def _test(self, TLp: List[pairing.pc_element], IL: List[pairing.pc_element]) -> bool:
+    def _trapdoor_scope(self, TLp, IDi, trapdoor_signature, client_id=None):
         """
-        Test whether the index matches the trapdoor
+        Verify the signature of a trapdoor, once per query
         :param TLp: Trapdoor
-        :param IL: Secure index
-        :return: True if the index matches the trapdoor
+        :param IDi: The id of the member that made the query
+        :param trapdoor_signature: Signature of the trapdoor
+        :param client_id: Only search the documents of this client, None to search all documents the member may
+        search
+        :return: The set of client ids whose documents may be searched, None if the documents of all clients may be
+        searched
         """
-        assert len(TLp) == len(IL), "Length of trapdoor and index do not match!"
-
-        PKs = self.PKs
+        if IDi in self.client_public_keys and verify_message(self.client_public_keys[IDi], TLp, trapdoor_signature):
+            scope = frozenset([IDi])
+        elif verify_message(self.consultant_public_key, TLp, trapdoor_signature):
+            scope = None
+        else:
+            scope = frozenset()
 
-        V = PKs['group'].pair_prod(TLp, IL)
-        return V == PKs['group'].init(GT, 1)
+        if client_id is None:
+            return scope
+        return frozenset([client_id]) if scope is None else scope & {client_id}
 
-    def exposed_search_index(self, TLp, CTi, trapdoor_signature):
+    def exposed_search_index(self, query: bytes):
         """
         Scan all secure indexes against the trapdoor
-        :param TLp: Trapdoor
-        :param CTi: Membership certificate
-        :param trapdoor_signature: Signature of the trapdoor
-        :return: Encrypted data `E(R)` for the member when the data includes the searched keywords or "No Data Matched"
-        for the member when the data does not contain the keywords
+        :param query: Query message with a single trapdoor, see `wire.pack_query`
+        :return: Files message with the encrypted data `E(R)` of the documents that include the searched keywords, see
+        `wire.pack_files`, or Access Denied
         """
-        TLp = deserialize_trapdoor(TLp, self.PKs)
+        self._sync()
+        trapdoors, CTi, signatures, client_id = self._unpack_query(query, single=True)
 
         if self.member_check(CTi):
-            result = []
+            doc_ids, = self._search(trapdoors, CTi['IDi'], signatures, client_id)
+            return wire.pack_files([self._load_file(doc_id) for doc_id in doc_ids])
+        else:
+            return config.ACCESS_DENIED
 
-            for IR, file, client_id in self._load_all_ir_and_files():
-                IR = deserialize_IL(IR, self.PKs)
-                if ((client_id == CTi['IDi'] and verify_message(self.client_public_keys[CTi['IDi']], TLp, trapdoor_signature)) or \
-                        verify_message(self.consultant_public_key, TLp, trapdoor_signature)) and \
-                        self._test(TLp, IR):
-                    result.append(file)
+    def exposed_search_ids(self, query: bytes):
+        """
+        Scan all secure indexes against the trapdoor, without reading any encrypted data
+        :param query: Query message with a single trapdoor, see `wire.pack_query`
+        :return: Handles of the matching documents, which can be fetched with `exposed_fetch_documents`, or
+        Access Denied
+        """
+        self._sync()
+        trapdoors, CTi, signatures, client_id = self._unpack_query(query, single=True)
 
-            return result
+        if self.member_check(CTi):
+            doc_ids, = self._search(trapdoors, CTi['IDi'], signatures, client_id)
+            return tuple(self._make_handle(doc_id, CTi['IDi']) for doc_id in doc_ids)
+        else:
+            return config.ACCESS_DENIED
+
+    def exposed_search_page(self, query: bytes, limit: int, cursor: bytes = None):
+        """
+        Scan the secure indexes against the trapdoor until `limit` matching documents are found
+        :param query: Query message with a single trapdoor, see `wire.pack_query`
+        :param limit: The maximum number of documents to return
+        :param cursor: The cursor returned with the previous page, None for the first page
+        :return: Tuple (handles, cursor) with the handles of the matching documents and the cursor of the next page,
+        which is None when there are no more pages, or Access Denied
+        """
+        if limit < 1:
+            raise InputError('The limit should be at least 1')
+        self._sync()
+        (TLp,), CTi, (trapdoor_signature,), client_id = self._unpack_query(query, single=True)
+
+        if self.member_check(CTi):
+            start = 0 if cursor is None else self._open_handle(cursor, CTi['IDi'], CURSOR)
+            scope = self._trapdoor_scope(TLp, CTi['IDi'], trapdoor_signature, client_id)
+            doc_ids, next_start = self._search_page(TLp, scope, start, limit)
+            handles = tuple(self._make_handle(doc_id, CTi['IDi']) for doc_id in doc_ids)
+            if next_start is None:
+                return handles, None
+            return handles, self._make_handle(next_start, CTi['IDi'], CURSOR)
+        else:
+            return config.ACCESS_DENIED
+
+    def exposed_search_many(self, query: bytes):
+        """
+        Scan all secure indexes against several trapdoors at once, reading every index only once
+        :param query: Query message with the trapdoors, see `wire.pack_query`
+        :return: For every trapdoor the handles of the matching documents, which can be fetched with
+        `exposed_fetch_documents`, or Access Denied
+        """
+        self._sync()
+        trapdoors, CTi, signatures, client_id = self._unpack_query(query)
+
+        if self.member_check(CTi):
+            return tuple(tuple(self._make_handle(doc_id, CTi['IDi']) for doc_id in doc_ids)
+                         for doc_ids in self._search(trapdoors, CTi['IDi'], signatures, client_id))
+        else:
+            return config.ACCESS_DENIED
 
+    def exposed_fetch_documents(self, handles, CTi: bytes):
+        """
+        Fetch the encrypted data of documents found by `exposed_search_ids`
+        :param handles: The handles of the documents
+        :param CTi: Membership certificate message of the member that searched for the documents, see `wire.pack_CTi`
+        :return: Files message with the encrypted data `E(R)` of every document, see `wire.pack_files`, or Access Denied
+        """
+        self._sync()
+        CTi = wire.unpack_CTi(CTi)
+        if self.member_check(CTi):
+            return wire.pack_files([self._load_file(self._open_handle(handle, CTi['IDi'])) for handle in handles])
+        else:
+            return config.ACCESS_DENIED
+
+    def exposed_open_document(self, handle: bytes, CTi: bytes):
+        """
+        Open a document found by `exposed_search_ids` to read its encrypted document in chunks
+        :param handle: The handle of the document
+        :param CTi: Membership certificate message of the member that searched for the document, see `wire.pack_CTi`
+        :return: Tuple (U, V, reader) with the serialized U, V and the reader of the encrypted document, or Access Denied
+        """
+        self._sync()
+        CTi = wire.unpack_CTi(CTi)
+        if self.member_check(CTi):
+            doc_id = self._open_handle(handle, CTi['IDi'])
+            U, V, Er_length = self.store.read_file_header(doc_id)
+            return U, V, DocumentReader(self.store, doc_id, Er_length)
         else:
             return config.ACCESS_DENIED
 
-    def _load_all_ir_and_files(self):
+    def exposed_subscribe(self, query: bytes, callback=None):
         """
-        Helper function to load all the files that are stored on the server
-        :return: List of all the files as tuples (IR, file)
+        Register a standing query, which is tested against every document that is added from now on. The matching
+        documents are queued until they are polled with `exposed_poll_subscription`. The query is removed when the
+        connection that registered it closes, or when more than `config.SUBSCRIPTION_QUEUE_SIZE` documents are queued.
+        :param query: Query message with a single trapdoor, see `wire.pack_query`
+        :param callback: Function that is called with the subscription id when new documents match, None to only poll
+        :return: The subscription id, or Access Denied
         """
-        result = []
-        files = next(os.walk(self.file_directory))[2]
-        for file_name in files:
-            data = json.load(open(os.path.join(self.file_directory, file_name)))
-            client_id = data['client_id']
-            IR = [base64.b64decode(x.encode('ascii')) for x in data['IR']]
+        self._sync()
+        (TLp,), CTi, (trapdoor_signature,), client_id = self._unpack_query(query, single=True)
+
+        if self.member_check(CTi):
+            scope = self._trapdoor_scope(TLp, CTi['IDi'], trapdoor_signature, client_id)
+            if scope == frozenset():
+                raise InputError('The trapdoor can not match any document')
+            subscription_id = os.urandom(SUBSCRIPTION_ID_SIZE)
+            with self._subscription_lock:
+                self.subscriptions[subscription_id] = Subscription(CTi['IDi'], TLp, scope,
+                                                                   getattr(self._connection, 'conn', None), callback)
+                if self._subscription_sync is None:
+                    self._subscription_sync = threading.Thread(target=self._sync_subscriptions, daemon=True)
+                    self._subscription_sync.start()
+            return subscription_id
+        else:
+            return config.ACCESS_DENIED
 
-            U = base64.b64decode(data['U'].encode('ascii'))
-            V = base64.b64decode(data['V'].encode('ascii'))
-            Er = base64.b64decode(data['Er'].encode('ascii'))
-            file = (U, V, Er)
+    def exposed_poll_subscription(self, subscription_id: bytes, CTi: bytes):
+        """
+        Get the documents that matched a standing query since the last poll
+        :param subscription_id: The subscription id returned by `exposed_subscribe`
+        :param CTi: Membership certificate message of the member that registered the query, see `wire.pack_CTi`
+        :return: Handles of the matching documents, which can be fetched with `exposed_fetch_documents`, or Access
+        Denied
+        """
+        self._sync()
+        CTi = wire.unpack_CTi(CTi)
+        with self._subscription_lock:
+            subscription = self.subscriptions.get(subscription_id)
+        if subscription is None or subscription.IDi != CTi['IDi']:
+            raise InputError('Unknown subscription')
 
-            result.append((IR, file, client_id))
+        if self.member_check(CTi):
+            with self._subscription_lock:
+                doc_ids, subscription.doc_ids = subscription.doc_ids, []
+            return tuple(self._make_handle(doc_id, CTi['IDi']) for doc_id in doc_ids)
+        else:
+            return config.ACCESS_DENIED
 
+    def exposed_unsubscribe(self, subscription_id: bytes):
+        """
+        Remove a standing query, the matches that were not polled yet are dropped
+        :param subscription_id: The subscription id returned by `exposed_subscribe`
+        """
+        with self._subscription_lock:
+            self.subscriptions.pop(subscription_id, None)
+
+    def _sync_subscriptions(self):
+        """
+        Sync periodically while there are standing queries, so the documents that other server processes add are
+        matched and pushed even when this process gets no requests
+        """
+        while not self._closed.wait(config.SUBSCRIPTION_SYNC_INTERVAL):
+            if self.subscriptions:
+                self._sync()
+
+    def _match_subscriptions(self):
+        """
+        Test the documents that were added since the last match against the standing queries, in one pass, and notify
+        the subscribers that have new matches
+        """
+        with self._subscription_lock:
+            # The scan workers only test the documents that were handed to them
+            start = self.matched_documents
+            stop = len(self.store) if self.scanner is None else self.scanned_documents
+            self.matched_documents = stop
+            if start == stop or not self.subscriptions:
+                return
+            for subscription_id, subscription in list(self.subscriptions.items()):
+                if subscription.connection is not None and subscription.connection.closed:
+                    del self.subscriptions[subscription_id]
+            subscriptions = list(self.subscriptions.items())
+            matches = self._scan([subscription.TLp for _id, subscription in subscriptions],
+                                 [subscription.scope for _id, subscription in subscriptions], start, stop)
+            notify = []
+            for (subscription_id, subscription), doc_ids in zip(subscriptions, matches):
+                if doc_ids:
+                    subscription.doc_ids.extend(doc_ids)
+                    if len(subscription.doc_ids) > config.SUBSCRIPTION_QUEUE_SIZE:
+                        # A subscriber that does not poll loses its query, its next poll fails instead of missing
+                        # documents
+                        del self.subscriptions[subscription_id]
+                    elif subscription.callback is not None:
+                        notify.append((subscription_id, subscription.callback))
+
+        # The subscribers poll the matches with their current certificate, so the notification holds no handles
+        for subscription_id, callback in notify:
+            try:
+                rpyc.async_(callback)(subscription_id)
+            except EOFError:
+                self.exposed_unsubscribe(subscription_id)
+
+    def _unpack_query(self, query: bytes, single: bool = False):
+        """
+        Unpack a query message, see `wire.pack_query`
+        :param query: The query message
+        :param single: Whether the query should have exactly one trapdoor
+        :return: Tuple (trapdoors, CTi, signatures, client_id) with the deserialized trapdoors
+        """
+        trapdoors, CTi, signatures, client_id = wire.unpack_query(query)
+        if single and len(trapdoors) != 1:
+            raise InputError('The query should have a single trapdoor')
+        return [deserialize_trapdoor(TLp, self.PKs) for TLp in trapdoors], CTi, signatures, client_id
+
+    def _search(self, trapdoors, IDi, signatures, client_id=None):
+        """
+        Find the documents the member may search that match the trapdoors
+        :param trapdoors: List of trapdoors
+        :param IDi: The id of the member that made the query
+        :param signatures: The signature of every trapdoor
+        :param client_id: Only search the documents of this client, None to search all documents
+        :return: For every trapdoor the list of matching document ids
+        """
+        scopes = [self._trapdoor_scope(TLp, IDi, signature, client_id)
+                  for TLp, signature in zip(trapdoors, signatures)]
+        return self._scan(trapdoors, scopes)
+
+    def _search_page(self, TLp, scope, start: int, limit: int):
+        """
+        Find the first `limit` documents from document id `start` on that match the trapdoor
+        :param TLp: Trapdoor
+        :param scope: The client ids whose documents the trapdoor may match, see `_trapdoor_scope`
+        :param start: The document id to start scanning at
+        :param limit: The maximum number of documents to find
+        :return: Tuple (doc_ids, next_start) where next_start is None when the scan has reached the last document
+        """
+        doc_ids = []
+        end = len(self.store)
+        while start < end and len(doc_ids) < limit:
+            # The scan workers get the documents in chunks, so they stop soon after enough documents are found
+            stop = end if self.scanner is None else min(start + config.SCAN_CHUNK_SIZE, end)
+            matches, = self._scan([TLp], [scope], start, stop, limit - len(doc_ids))
+            doc_ids.extend(matches)
+            start = stop
+
+        if len(doc_ids) < limit:
+            return doc_ids, None
+        next_start = doc_ids[limit - 1] + 1
+        return doc_ids[:limit], next_start if next_start < len(self.store) else None
+
+    def _make_handle(self, doc_id: int, IDi: str, kind: bytes = DOCUMENT_HANDLE) -> bytes:
+        mac = hmac.new(self.handle_key, kind + struct.pack('<Q', doc_id) + IDi.encode(), hashlib.sha256).digest()
+        return HANDLE.pack(doc_id, mac[:16])
+
+    def _open_handle(self, handle: bytes, IDi: str, kind: bytes = DOCUMENT_HANDLE) -> int:
+        """
+        Get the document id of a handle
+        :param handle: The handle of the document, or a cursor
+        :param IDi: The id of the member that presents the handle
+        :param kind: The kind of handle
+        :return: The document id
+        """
+        if len(handle) != HANDLE.size:
+            raise InputError('Invalid {}'.format(kind.decode()))
+        doc_id, _mac = HANDLE.unpack(handle)
+        if doc_id >= len(self.store) or not hmac.compare_digest(handle, self._make_handle(doc_id, IDi, kind)):
+            raise InputError('Invalid {}'.format(kind.decode()))
+        return doc_id
+
+    def _scan(self, trapdoors, scopes, start: int = 0, stop: int = None, limit: int = None):
+        """
+        Test the secure indexes against the trapdoors in one pass, using the scan workers if there are any
+        :param trapdoors: List of trapdoors
+        :param scopes: For every trapdoor the client ids whose documents it may match, see `_trapdoor_scope`
+        :param start: The first document id to test
+        :param stop: The document id to stop before, None to test up to the last document
+        :param limit: Stop the scan once every trapdoor has this many matches. Only the scan in the server process
+        stops early, the scan workers always test the whole range.
+        :return: For every trapdoor the list of matching document ids, in document order
+        """
+        if stop is None:
+            stop = len(self.store)
+        if self.scanner is not None:
+            return self.scanner.scan([serialize_trapdoor(TLp, self.PKs) for TLp in trapdoors], scopes, start, stop)
+
+        result = [[] for _ in trapdoors]
+        queries = [(TLp, scope, doc_ids)
+                   for TLp, scope, doc_ids in zip(trapdoors, scopes, result) if scope != frozenset()]
+        if not queries:
+            return result
+
+        client_ids = scopes_client_ids(scope for _TLp, scope, _doc_ids in queries)
+        for doc_id in self.store.doc_ids(client_ids, start, stop):
+            client_id, IR = self._load_index(doc_id)
+            for TLp, scope, doc_ids in queries:
+                if in_scope(scope, client_id) and self._test(TLp, IR):
+                    doc_ids.append(doc_id)
+            if limit is not None and all(len(doc_ids) >= limit for _TLp, _scope, doc_ids in queries):
+                break
         return result
 
+    def _test(self, TLp: List[pairing.pc_element], IL: List[pairing.pc_element]) -> bool:
+        """
+        Test whether the index matches the trapdoor
+        :param TLp: Trapdoor
+        :param IL: Secure index, the concatenation of the indexes of the document
+        :return: True if any of the indexes matches the trapdoor
+        """
+        return index_matches(self.PKs['group'], TLp, IL)
+
+    def _load_index(self, doc_id):
+        """
+        Helper function to get the deserialized secure index of a document, from the index cache if possible
+        :param doc_id: The id of the document
+        :return: Tuple (client_id, IR)
+        """
+        entry = self.index_cache.get(doc_id)
+        if entry is not None:
+            return entry
+
+        _doc_id, client_id, IR = self._load_index_serialized(doc_id)
+        IL = deserialize_IL(IR, self.PKs)
+        self.index_cache.put(doc_id, client_id, IL, sum(len(x) for x in IR))
+        return client_id, IL
+
+    def _load_index_serialized(self, doc_id):
+        """
+        Helper function to load the serialized secure index of a document
+        :param doc_id: The id of the document
+        :return: Tuple (doc_id, client_id, IR)
+        """
+        client_id, IR = self.store.read_index(doc_id)
+        return doc_id, client_id, IR
+
+    def _load_file(self, doc_id):
+        """
+        Helper function to load the encrypted file of a document
+        :param doc_id: The id of the document
+        :return: The file as a tuple (U, V, Er)
+        """
+        return self.store.read_file(doc_id)
+
+    def close(self):
+        self._closed.set()
+        if self.scanner is not None:
+            self.scanner.close()
+        self.store.close()
+        self.state.close()
+
+
+class Subscription:
+    """
+    A standing query, see `Server.exposed_subscribe`
+    """
+
+    def __init__(self, IDi: str, TLp, scope, connection, callback=None):
+        """
+        :param IDi: The id of the member that registered the query
+        :param TLp: Trapdoor
+        :param scope: The client ids whose documents the trapdoor may match, see `Server._trapdoor_scope`
+        :param connection: The connection that registered the query
+        :param callback: Function that is called with the subscription id when new documents match
+        """
+        self.IDi = IDi
+        self.TLp = TLp
+        self.scope = scope
+        self.connection = connection
+        self.callback = callback
+        # Matching documents that were not polled yet
+        self.doc_ids = []
+
+
+class DocumentUpload:
+    """
+    A file of which the encrypted document is streamed to the server, see `Server.exposed_begin_upload`. The encrypted
+    document is written to an anonymous temporary file, so an upload that is never finished leaves nothing behind.
+    """
+
+    def __init__(self, server: Server, client_id: str, IR, IL, U: bytes, V: bytes):
+        self.server = server
+        self.client_id = client_id
+        self.IR = IR
+        # The deserialized index, checked before the upload started
+        self.IL = IL
+        self.U = U
+        self.V = V
+        self.file = tempfile.TemporaryFile(dir=server.file_directory)
+        self.hash = SHA512.new()
+
+    def exposed_write(self, chunk: bytes):
+        """
+        Write the next chunk of the encrypted document
+        """
+        if self.file.closed:
+            raise InputError('The upload is finished')
+        self.file.write(chunk)
+        self.hash.update(chunk)
+
+    def exposed_finish(self, signature: bytes):
+        """
+        Add the file to the server
+        :param signature: Signature of the encrypted document
+        """
+        try:
+            self.server._check_signature(self.client_id, self.hash, signature)
+            self.server._store_files(self.client_id, [(self.IR, (self.U, self.V, self.file))], [self.IL])
+        finally:
+            self.file.close()
+
+
+class DocumentReader:
+    """
+    Reads the encrypted document of a document in chunks, see `Server.exposed_open_document`
+    """
+
+    def __init__(self, store: PartitionedStore, doc_id: int, length: int):
+        self.store = store
+        self.doc_id = doc_id
+        self.position = 0
+        self.exposed_length = length
+
+    def exposed_read(self, size: int) -> bytes:
+        """
+        Read the next chunk of the encrypted document, at most `config.DOCUMENT_CHUNK_SIZE` bytes
+        :return: The chunk, empty at the end of the encrypted document
+        """
+        data = self.store.read_file_range(self.doc_id, self.position, min(size, config.DOCUMENT_CHUNK_SIZE))
+        self.position += len(data)
+        return data
+
+
+def serve_processes(server: ThreadedServer, make_service, processes: int):
+    """
+    Serve in several processes that accept the connections on the listening socket of `server`. Every process makes
+    its own service, as the open files of the store and the state log can not be shared.
+    :param server: The server, which has not been started yet
+    :param make_service: Function that makes the service of a process
+    :param processes: The number of processes
+    """
+    pids = []
+    for _ in range(processes):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                service = make_service()
+                server.service = service
+                try:
+                    server.start()
+                finally:
+                    service.close()
+            finally:
+                os._exit(0)
+        pids.append(pid)
+
+    try:
+        for pid in pids:
+            os.waitpid(pid, 0)
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+
 
 if __name__ == '__main__':
     try:
         consultant = rpyc.ssl_connect(config.CONSULTANT_IP, config.CONSULTANT_PORT, keyfile="cert/server/key.pem", certfile="cert/server/certificate.pem", config=config.config)
-        PKs = consultant.root.get_public_parameters()
+        PKs = wire.unpack_PKs(consultant.root.get_public_parameters())
         consultant_public_key = deserialize_public_key(consultant.root.get_public_key())
         PKs = deserialize_PKs(PKs)
         authenticator = SSLAuthenticator("cert/server/key.pem", "cert/server/certificate.pem")
-        server = ThreadedServer(Server(PKs, consultant_public_key), port=config.SERVER_PORT, protocol_config=config.config, authenticator=authenticator)
-        server.start()
+        # The state of a previous run belongs to other public parameters
+        if os.path.exists(os.path.join(FILE_DIRECTORY, STATE_FILE)):
+            os.remove(os.path.join(FILE_DIRECTORY, STATE_FILE))
+        if config.SERVER_PROCESSES > 1:
+            # The listener is made with the service class, which names its logger, every process serves its own object
+            server = ThreadedServer(Server, port=config.SERVER_PORT, protocol_config=config.config, authenticator=authenticator)
+            handle_key = os.urandom(32)
+            # Every process scans the indexes itself, the processes already use the cores
+            serve_processes(server, lambda: Server(PKs, consultant_public_key, 1, handle_key), config.SERVER_PROCESSES)
+        else:
+            service = Server(PKs, consultant_public_key)
+            server = ThreadedServer(service, port=config.SERVER_PORT, protocol_config=config.config, authenticator=authenticator)
+            try:
+                server.start()
+            finally:
+                service.close()
     finally:
         shutil.rmtree(FILE_DIRECTORY)
@@ -0,0 +1,75 @@
+import fcntl
+import os
+import struct
+import threading
+from contextlib import contextmanager
+
+# record kind, payload length
+RECORD = struct.Struct('<BI')
+
+
+class StateLog:
+    """
+    Append-only log of state that is shared by several server processes.
+
+    Every process opens the log itself and reads the records appended by the others when it syncs. Changes that depend
+    on the current state are made while holding the log, which excludes the threads of this process and the other
+    processes.
+    """
+
+    def __init__(self, path: str):
+        """
+        Open the log, creating it if it does not exist yet. Every process has to open the log itself, as the file lock
+        is shared by processes that share the file.
+        :param path: The path of the log file
+        """
+        self._file = open(path, 'a+b')
+        self._position = 0
+        # Held while reading and applying records, so they are applied in log order
+        self.lock = threading.RLock()
+
+    @contextmanager
+    def locked(self):
+        """
+        Hold the log exclusively, across the threads of this process and the other processes
+        """
+        with self.lock:
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def read(self):
+        """
+        Read the records that were appended since the last read
+        :return: List of tuples (kind, payload)
+        """
+        with self.lock:
+            size = os.fstat(self._file.fileno()).st_size
+            if size == self._position:
+                return []
+            data = os.pread(self._file.fileno(), size - self._position, self._position)
+
+            records = []
+            offset = 0
+            # A record that is still being written is read on the next sync
+            while offset + RECORD.size <= len(data):
+                kind, length = RECORD.unpack_from(data, offset)
+                end = offset + RECORD.size + length
+                if end > len(data):
+                    break
+                records.append((kind, data[offset + RECORD.size:end]))
+                offset = end
+            self._position += offset
+            return records
+
+    def append(self, kind: int, payload: bytes):
+        """
+        Append a record, only while holding the log
+        """
+        self._file.write(RECORD.pack(kind, len(payload)) + payload)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,327 @@
+import base64
+import struct
+
+from errors import InputError
+
+# Every message starts with the version of the format and the kind of message
+WIRE_VERSION = 2
+HEADER = struct.Struct('<BB')
+
+PKS_MESSAGE = 1
+SKG_MESSAGE = 2
+CTI_MESSAGE = 3
+QUERY_MESSAGE = 4
+UPLOAD_MESSAGE = 5
+FILES_MESSAGE = 6
+STREAM_UPLOAD_MESSAGE = 7
+
+LENGTH = struct.Struct('<I')
+COUNT = struct.Struct('<I')
+INTEGER = struct.Struct('<Q')
+# number of points, point width
+POINTS = struct.Struct('<HH')
+
+# Charm serializes a G1 element as its type followed by the base64 encoded compressed point
+G1_PREFIX = b'1:'
+
+
+def point_to_bytes(point: bytes) -> bytes:
+    """
+    Convert a serialized G1 element to its raw compressed point
+    """
+    assert point.startswith(G1_PREFIX), "Only G1 elements can be encoded as points"
+    return base64.b64decode(point[len(G1_PREFIX):])
+
+
+def point_from_bytes(raw) -> bytes:
+    """
+    Convert a raw compressed point to a serialized G1 element
+    """
+    return G1_PREFIX + base64.b64encode(raw)
+
+
+class _Writer:
+    def __init__(self, kind: int):
+        self.parts = [HEADER.pack(WIRE_VERSION, kind)]
+
+    def integer(self, x: int):
+        self.parts.append(INTEGER.pack(x))
+
+    def count(self, x: int):
+        self.parts.append(COUNT.pack(x))
+
+    def bytes(self, x: bytes):
+        self.parts.append(LENGTH.pack(len(x)))
+        self.parts.append(x)
+
+    def string(self, x: str):
+        self.bytes(x.encode())
+
+    def big_integer(self, x: int):
+        self.bytes(x.to_bytes((x.bit_length() + 7) // 8, 'big'))
+
+    def element(self, x: bytes):
+        """
+        Write a serialized charm element of any type as its type and raw value
+        """
+        element_type, value = x.split(b':', 1)
+        self.parts.append(bytes([int(element_type)]))
+        self.bytes(base64.b64decode(value))
+
+    def points(self, points):
+        """
+        Write a list of serialized G1 elements as fixed-width compressed points
+        """
+        points = [point_to_bytes(x) for x in points]
+        width = len(points[0]) if points else 0
+        if any(len(x) != width for x in points):
+            raise InputError('Points should have a fixed width')
+        self.parts.append(POINTS.pack(len(points), width))
+        self.parts.extend(points)
+
+    def build(self) -> bytes:
+        return b''.join(self.parts)
+
+
+class _Reader:
+    def __init__(self, data: bytes, kind: int):
+        self.data = memoryview(data)
+        self.position = 0
+        version, message_kind = self._unpack(HEADER)
+        if version != WIRE_VERSION:
+            raise InputError('Unsupported message version {}'.format(version))
+        if message_kind != kind:
+            raise InputError('Unexpected message kind {}'.format(message_kind))
+
+    def _take(self, n: int) -> memoryview:
+        if self.position + n > len(self.data):
+            raise InputError('Truncated message')
+        view = self.data[self.position:self.position + n]
+        self.position += n
+        return view
+
+    def _unpack(self, format: struct.Struct):
+        return format.unpack(self._take(format.size))
+
+    def integer(self) -> int:
+        return self._unpack(INTEGER)[0]
+
+    def count(self) -> int:
+        return self._unpack(COUNT)[0]
+
+    def bytes(self) -> bytes:
+        length, = self._unpack(LENGTH)
+        return bytes(self._take(length))
+
+    def string(self) -> str:
+        return self.bytes().decode()
+
+    def big_integer(self) -> int:
+        return int.from_bytes(self.bytes(), 'big')
+
+    def element(self) -> bytes:
+        element_type = self._take(1)[0]
+        return str(element_type).encode() + b':' + base64.b64encode(self.bytes())
+
+    def points(self):
+        n, width = self._unpack(POINTS)
+        raw = self._take(n * width)
+        return [point_from_bytes(raw[i * width:(i + 1) * width]) for i in range(n)]
+
+    def end(self):
+        if self.position != len(self.data):
+            raise InputError('Trailing data after message')
+
+
+def pack_PKs(PKs) -> bytes:
+    """
+    Pack the serialized public parameters, see `serialization.serialize_PKs`
+    """
+    writer = _Writer(PKS_MESSAGE)
+    writer.integer(PKs['l'])
+    writer.big_integer(int(PKs['q']))
+    writer.string(PKs['curve'])
+    writer.integer(PKs['secparam'])
+    for k in ['g', 'X', 'Y']:
+        writer.element(PKs[k])
+    return writer.build()
+
+
+def unpack_PKs(data: bytes):
+    """
+    :return: The serialized public parameters, see `serialization.deserialize_PKs`
+    """
+    reader = _Reader(data, PKS_MESSAGE)
+    PKs = {'l': reader.integer(), 'q': reader.big_integer(), 'curve': reader.string(), 'secparam': reader.integer()}
+    for k in ['g', 'X', 'Y']:
+        PKs[k] = reader.element()
+    reader.end()
+    return PKs
+
+
+def pack_SKg(SKg) -> bytes:
+    """
+    Pack the serialized group secret key, see `serialization.serialize_SKg`
+    """
+    writer = _Writer(SKG_MESSAGE)
+    for k in ['α', 'P', 'Pp', 'Q', 'Qp']:
+        writer.element(SKg[k])
+    return writer.build()
+
+
+def unpack_SKg(data: bytes):
+    reader = _Reader(data, SKG_MESSAGE)
+    SKg = {k: reader.element() for k in ['α', 'P', 'Pp', 'Q', 'Qp']}
+    reader.end()
+    return SKg
+
+
+def pack_CTi(CTi) -> bytes:
+    """
+    Pack a serialized membership certificate, see `serialization.serialize_CTi`
+    """
+    writer = _Writer(CTI_MESSAGE)
+    writer.string(CTi['IDi'])
+    writer.points([CTi['ai'], CTi['bi'], CTi['ci']])
+    return writer.build()
+
+
+def unpack_CTi(data: bytes):
+    reader = _Reader(data, CTI_MESSAGE)
+    IDi = reader.string()
+    points = reader.points()
+    if len(points) != 3:
+        raise InputError('A certificate has three points')
+    reader.end()
+    ai, bi, ci = points
+    return {'IDi': IDi, 'ai': ai, 'bi': bi, 'ci': ci}
+
+
+def pack_query(trapdoors, CTi: bytes, signatures, client_id: str = None) -> bytes:
+    """
+    Pack a search query
+    :param trapdoors: List of serialized trapdoors
+    :param CTi: Membership certificate message, see `pack_CTi`
+    :param signatures: The signature of every trapdoor
+    :param client_id: Only search the documents of this client, None to search all documents
+    """
+    assert len(trapdoors) == len(signatures), "Every trapdoor needs a signature"
+    writer = _Writer(QUERY_MESSAGE)
+    writer.bytes(CTi)
+    writer.count(len(trapdoors))
+    for TLp, signature in zip(trapdoors, signatures):
+        writer.points(TLp)
+        writer.bytes(signature)
+    writer.string('' if client_id is None else client_id)
+    return writer.build()
+
+
+def unpack_query(data: bytes):
+    """
+    :return: Tuple (trapdoors, CTi, signatures, client_id) with the serialized membership certificate, see
+    `pack_query`
+    """
+    reader = _Reader(data, QUERY_MESSAGE)
+    CTi = unpack_CTi(reader.bytes())
+    trapdoors = []
+    signatures = []
+    for _ in range(reader.count()):
+        trapdoors.append(reader.points())
+        signatures.append(reader.bytes())
+    client_id = reader.string() or None
+    reader.end()
+    return trapdoors, CTi, signatures, client_id
+
+
+def pack_upload(client_id: str, files) -> bytes:
+    """
+    Pack files to upload to the server
+    :param client_id: The client id the files belong to
+    :param files: List of tuples (IR, Er) with the list of serialized indexes and the encrypted data, see
+    `serialization.serialize_IL` and `serialization.serialize_Er`
+    """
+    writer = _Writer(UPLOAD_MESSAGE)
+    writer.string(client_id)
+    writer.count(len(files))
+    for IR, (U, V, Ed, signature) in files:
+        writer.count(len(IR))
+        for IL in IR:
+            writer.points(IL)
+        writer.points([U])
+        writer.bytes(V)
+        writer.bytes(Ed)
+        writer.bytes(signature)
+    return writer.build()
+
+
+def unpack_upload(data: bytes):
+    """
+    :return: Tuple (client_id, files), see `pack_upload`
+    """
+    reader = _Reader(data, UPLOAD_MESSAGE)
+    client_id = reader.string()
+    files = []
+    for _ in range(reader.count()):
+        IR = [reader.points() for _ in range(reader.count())]
+        U, = reader.points()
+        files.append((IR, (U, reader.bytes(), reader.bytes(), reader.bytes())))
+    reader.end()
+    return client_id, files
+
+
+def pack_stream_upload(client_id: str, IR, U: bytes, V: bytes) -> bytes:
+    """
+    Pack the start of an upload of which the encrypted document is streamed to the server afterwards
+    :param client_id: The client id the file belongs to
+    :param IR: List of serialized indexes
+    :param U: The serialized U of the encrypted file
+    :param V: V of the encrypted file
+    """
+    writer = _Writer(STREAM_UPLOAD_MESSAGE)
+    writer.string(client_id)
+    writer.count(len(IR))
+    for IL in IR:
+        writer.points(IL)
+    writer.points([U])
+    writer.bytes(V)
+    return writer.build()
+
+
+def unpack_stream_upload(data: bytes):
+    """
+    :return: Tuple (client_id, IR, U, V), see `pack_stream_upload`
+    """
+    reader = _Reader(data, STREAM_UPLOAD_MESSAGE)
+    client_id = reader.string()
+    IR = [reader.points() for _ in range(reader.count())]
+    U, = reader.points()
+    V = reader.bytes()
+    reader.end()
+    return client_id, IR, U, V
+
+
+def pack_files(files) -> bytes:
+    """
+    Pack encrypted files returned by the server
+    :param files: List of tuples (U, V, Ed) with the serialized U
+    """
+    writer = _Writer(FILES_MESSAGE)
+    writer.count(len(files))
+    for U, V, Ed in files:
+        writer.points([U])
+        writer.bytes(V)
+        writer.bytes(Ed)
+    return writer.build()
+
+
+def unpack_files(data: bytes):
+    """
+    :return: List of tuples (U, V, Ed), see `pack_files`
+    """
+    reader = _Reader(data, FILES_MESSAGE)
+    files = []
+    for _ in range(reader.count()):
+        U, = reader.points()
+        files.append((U, reader.bytes(), reader.bytes()))
+    reader.end()
+    return files